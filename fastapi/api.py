@@ -17,15 +17,22 @@ from pathlib import Path
 import tempfile
 import httpx
 import base64
+import asyncio
 
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 import chromadb
 
+from laravel_integration import (
+    post_sei_runner, extrair_json_sucesso, cache_respostas_llm, chave_cache,
+    LEGISLACAO_TIMEOUT_CHAT, aguardar_legislacao, RE_FENCE, FiltroStreamTexto,
+    eventos_sse_openai, eventos_sse_texto, resposta_sse
+)
+
 # PDF/DOCX parsing (v2.0)
 try:
     import fitz  # PyMuPDF
@@ -50,8 +57,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# OpenAI
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OpenAI (cliente assíncrono único: as chamadas não bloqueiam o event loop)
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=60.0, max_retries=2)
 
 # Modelos (v2.0)
 MODELOS = {
@@ -440,6 +447,7 @@ class ValidarRequest(BaseModel):
 
 class MelhorarTextoRequest(BaseModel):
     texto: str
+    stream: bool = False
 
 class InserirSEIRequest(BaseModel):
     nup: str
@@ -462,6 +470,7 @@ class ChatRequest(BaseModel):
     tema_sensivel: bool = False
     modelo_forcado: Optional[str] = None
     acao: str = "CHAT_LIVRE"
+    stream: bool = False
 
 class CredenciaisSEI(BaseModel):
     usuario: str
@@ -552,6 +561,7 @@ def listar_autoridades() -> List[Dict]:
 # ============================================================================
 
 def consultar_legislacao(consulta: str, n_results: int = 5) -> List[Dict]:
+    """Busca no ChromaDB (síncrona: nas rotas async, chamar via asyncio.to_thread)"""
     if not leis_collection:
         return []
     try:
@@ -690,20 +700,19 @@ async def chamar_sei_reader(nup: str, usuario_sei: str) -> Dict:
 async def chamar_sei_reader_fallback(nup: str, sigla: str) -> Dict:
     """Fallback para o runner antigo"""
     try:
-        async with httpx.AsyncClient(timeout=180.0) as http_client:
-            response = await http_client.post(
-                f"{SEI_RUNNER_URL}/run",
-                json={"mode": "detalhar", "nup": nup, "sigla": sigla}
-            )
-            data = response.json()
+        response = await post_sei_runner(
+            "/run",
+            {"mode": "detalhar", "nup": nup, "sigla": sigla},
+            timeout=180.0
+        )
+        data = response.json()
         
         if data.get("ok") == False:
             return {"sucesso": False, "erro": data.get("error"), "nup": nup}
         
-        output = data.get("output", "")
-        json_match = re.search(r'\{[\s\S]*"sucesso"[\s\S]*\}', output)
-        if json_match:
-            return json.loads(json_match.group())
+        resultado = extrair_json_sucesso(data.get("output", "") or "")
+        if resultado:
+            return resultado
         
         return {"sucesso": False, "erro": "Erro ao parsear", "nup": nup}
     except Exception as e:
@@ -721,31 +730,26 @@ async def chamar_sei_writer(nup: str, tipo: str, destinatario: str, html: str, u
         
         sigla = diretoria['sigla']
         
-        async with httpx.AsyncClient(timeout=180.0) as http_client:
-            response = await http_client.post(
-                f"{SEI_RUNNER_URL}/run",
-                json={
-                    "mode": "atuar",
-                    "nup": nup,
-                    "sigla": sigla,
-                    "tipo_documento": tipo,
-                    "destinatario": destinatario,
-                    "texto_despacho": html
-                }
-            )
-            data = response.json()
+        response = await post_sei_runner(
+            "/run",
+            {
+                "mode": "atuar",
+                "nup": nup,
+                "sigla": sigla,
+                "tipo_documento": tipo,
+                "destinatario": destinatario,
+                "texto_despacho": html
+            },
+            timeout=180.0
+        )
+        data = response.json()
         
         if data.get("ok") == False:
             return {"sucesso": False, "erro": data.get("error", "Erro desconhecido")}
         
-        output = data.get("output", "")
-        json_match = re.search(r'\{[\s\S]*"sucesso"[\s\S]*\}', output)
-        if json_match:
-            try:
-                result = json.loads(json_match.group())
-                return result
-            except json.JSONDecodeError:
-                pass
+        resultado = extrair_json_sucesso(data.get("output", "") or "")
+        if resultado:
+            return resultado
         
         return {"sucesso": True, "mensagem": "Documento inserido"}
         
@@ -759,7 +763,7 @@ async def chamar_sei_writer(nup: str, tipo: str, destinatario: str, html: str, u
 async def analisar_processo_ia(conteudo: str, nup: str) -> Dict:
     """Analisa processo com identificação de pontos a responder - v1.8 COMPLETA"""
     
-    legislacao = consultar_legislacao(conteudo[:1000], 3)
+    legislacao = await asyncio.to_thread(consultar_legislacao, conteudo[:1000], 3)
     leg_texto = formatar_legislacao(legislacao)
     
     prompt_template = carregar_prompt("analise_processo")
@@ -818,7 +822,7 @@ IMPORTANTE:
     system = SYSTEM_PROMPTS.get("analise", "Analista de processos. Responda JSON.")
     
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=MODELO_IA,
             messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}],
             temperature=0.3, max_tokens=2500
@@ -853,7 +857,7 @@ async def gerar_documento_ia(analise: Dict, tipo_doc: str, destinatario: str, nu
     remetente = buscar_remetente(usuario_sei)
     
     tipo_demanda = analise.get("tipo_demanda", "")
-    legislacao = consultar_legislacao(tipo_demanda, 3)
+    legislacao = await asyncio.to_thread(consultar_legislacao, tipo_demanda, 3)
     leg_texto = formatar_legislacao(legislacao)
     
     dados_dest = ""
@@ -887,7 +891,7 @@ async def gerar_documento_ia(analise: Dict, tipo_doc: str, destinatario: str, nu
     system = SYSTEM_PROMPTS.get("documento", "Redator oficial do CBMAC.")
     
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=MODELO_IA,
             messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}],
             temperature=0.4, max_tokens=2500
@@ -901,20 +905,48 @@ async def gerar_documento_ia(analise: Dict, tipo_doc: str, destinatario: str, nu
     except Exception as e:
         return f"<p>• NUP: {nup}<br>• Tipo de documento: {tipo_doc}</p><p>Erro: {e}</p>"
 
-async def melhorar_texto_ia(texto: str) -> str:
-    """Melhora texto - v1.8"""
+def mensagens_melhorar_texto(texto: str) -> List[Dict]:
     prompt_template = carregar_prompt("melhorar_texto") or carregar_prompt("revisar_texto")
     prompt = prompt_template.format(texto=texto) if prompt_template else f"Melhore:\n{texto}"
     system = SYSTEM_PROMPTS.get("revisor", "Revisor.")
+    return [{"role": "system", "content": system}, {"role": "user", "content": prompt}]
+
+async def melhorar_texto_ia(texto: str) -> str:
+    """Melhora texto - v1.8"""
+    messages = mensagens_melhorar_texto(texto)
+    chave = chave_cache("melhorar-texto", MODELO_IA, messages[0]["content"], messages[1]["content"])
+    texto_melhorado = cache_respostas_llm.get(chave)
+    if texto_melhorado is not None:
+        return texto_melhorado
     try:
-        response = client.chat.completions.create(
-            model=MODELO_IA,
-            messages=[{"role": "system", "content": system}, {"role": "user", "content": prompt}],
-            temperature=0.3, max_tokens=1500
+        response = await client.chat.completions.create(
+            model=MODELO_IA, messages=messages, temperature=0.3, max_tokens=1500
         )
-        return response.choices[0].message.content.strip()
+        texto_melhorado = RE_FENCE.sub('', response.choices[0].message.content).strip()
     except:
         return texto
+    if texto_melhorado:
+        cache_respostas_llm.set(chave, texto_melhorado)
+    return texto_melhorado
+
+async def melhorar_texto_ia_sse(texto: str):
+    """Melhora texto via SSE: mesmo texto final de melhorar_texto_ia, enviado à medida que chega"""
+    messages = mensagens_melhorar_texto(texto)
+    chave = chave_cache("melhorar-texto", MODELO_IA, messages[0]["content"], messages[1]["content"])
+    texto_melhorado = cache_respostas_llm.get(chave)
+    if texto_melhorado is not None:
+        return resposta_sse(eventos_sse_texto(texto_melhorado))
+    try:
+        response = await client.chat.completions.create(
+            model=MODELO_IA, messages=messages, temperature=0.3, max_tokens=1500, stream=True
+        )
+    except:
+        return resposta_sse(eventos_sse_texto(texto, cache=False))
+
+    def _guardar(texto_completo: str):
+        if texto_completo:
+            cache_respostas_llm.set(chave, texto_completo)
+    return resposta_sse(eventos_sse_openai(response, ao_concluir=_guardar, filtro=FiltroStreamTexto()))
 
 # ============================================================================
 # ENDPOINTS DE AUTENTICAÇÃO (v1.8)
@@ -983,9 +1015,17 @@ async def upload_arquivo(
 # ============================================================================
 
 @app.post("/api/chat")
-async def chat_analitico(req: ChatRequest, request: Request):
-    """Chat analítico efêmero - não persiste histórico, apenas metadados"""
+async def chat_analitico(
+    req: ChatRequest,
+    request: Request,
+    stream: bool = Query(False, description="Responde via SSE (mesmo que \"stream\": true no corpo)")
+):
+    """Chat analítico efêmero - não persiste histórico, apenas metadados ("stream": true ou ?stream=1 responde via SSE)"""
     try:
+        streaming = req.stream or stream
+        # Legislação do ChromaDB em paralelo com a montagem do contexto
+        leis_task = asyncio.create_task(asyncio.to_thread(consultar_legislacao, req.mensagem, 3))
+        
         if req.modelo_forcado:
             modelo = req.modelo_forcado
         else:
@@ -1007,7 +1047,11 @@ TEXTO CANÔNICO DO PROCESSO (Estado Único da Verdade):
 {req.texto_canonico}
 """
         
-        legislacao = consultar_legislacao(req.mensagem, 3)
+        # Chat é interativo: segue sem legislação em vez de esperar o RAG
+        # (a thread da consulta não é interrompida e termina em segundo plano)
+        legislacao = await aguardar_legislacao(
+            leis_task, LEGISLACAO_TIMEOUT_CHAT, origem="ChromaDB", padrao=[]
+        )
         rag_texto = formatar_legislacao(legislacao)
         
         anexo_texto = ""
@@ -1036,27 +1080,49 @@ SOLICITAÇÃO DO USUÁRIO:
 {req.mensagem}
 """
         
-        response = client.chat.completions.create(
-            model=modelo,
-            messages=[
-                {"role": "system", "content": CHAT_ANALITICO_PROMPT},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0.4,
-            max_tokens=3000
-        )
-        
-        resposta = response.choices[0].message.content.strip()
+        chave = chave_cache("chat-analitico", modelo, user_message)
+        resposta = cache_respostas_llm.get(chave)
+        em_cache = resposta is not None
+        if not em_cache:
+            response = await client.chat.completions.create(
+                model=modelo,
+                messages=[
+                    {"role": "system", "content": CHAT_ANALITICO_PROMPT},
+                    {"role": "user", "content": user_message}
+                ],
+                temperature=0.4,
+                max_tokens=3000,
+                stream=streaming
+            )
+            
+            if not streaming:
+                resposta = response.choices[0].message.content.strip()
+                if resposta:
+                    cache_respostas_llm.set(chave, resposta)
         
         ip = request.client.host if request.client else "unknown"
         registrar_auditoria(req.usuario_sei, acao_log, f"Modelo: {modelo}", ip)
         
-        return JSONResponse({
+        if streaming:
+            if em_cache:
+                return resposta_sse(eventos_sse_texto(resposta))
+
+            def _guardar(resposta_completa: str):
+                if resposta_completa:
+                    cache_respostas_llm.set(chave, resposta_completa)
+            # Sem cercas a remover: só o strip() da resposta completa
+            filtro = FiltroStreamTexto(remover_cercas=False)
+            return resposta_sse(eventos_sse_openai(response, ao_concluir=_guardar, filtro=filtro))
+        
+        resultado = {
             "sucesso": True,
             "resposta": resposta,
             "modelo_usado": modelo,
             "acao_log": acao_log
-        })
+        }
+        if em_cache:
+            resultado["cache"] = True
+        return JSONResponse(resultado)
         
     except Exception as e:
         return JSONResponse({"sucesso": False, "erro": str(e)})
@@ -1141,8 +1207,13 @@ async def validar(req: ValidarRequest):
     return {"aprovado": not any(v['tipo'] == 'error' for v in validacoes), "validacoes": validacoes}
 
 @app.post("/api/melhorar-texto")
-async def melhorar_texto(req: MelhorarTextoRequest):
-    """Endpoint para melhorar texto - v1.8"""
+async def melhorar_texto(
+    req: MelhorarTextoRequest,
+    stream: bool = Query(False, description="Responde via SSE (mesmo que \"stream\": true no corpo)")
+):
+    """Endpoint para melhorar texto - v1.8 ("stream": true ou ?stream=1 responde via SSE)"""
+    if req.stream or stream:
+        return await melhorar_texto_ia_sse(req.texto)
     return {"texto_melhorado": await melhorar_texto_ia(req.texto)}
 
 @app.post("/api/inserir-sei")
@@ -1159,7 +1230,8 @@ async def inserir_sei(req: InserirSEIRequest, request: Request):
 @app.post("/api/consultar-lei")
 async def consultar_lei(req: ConsultarLeiRequest):
     """Endpoint para consultar legislação - v1.8"""
-    return {"consulta": req.consulta, "resultados": consultar_legislacao(req.consulta, req.n_results)}
+    resultados = await asyncio.to_thread(consultar_legislacao, req.consulta, req.n_results)
+    return {"consulta": req.consulta, "resultados": resultados}
 
 @app.get("/api/usuarios")
 async def get_usuarios():
@@ -1256,12 +1328,8 @@ async def chamar_blocos_runner(acao: str, usuario_sei: str, credenciais: Optiona
         payload.update(kwargs)
         
         # Chama Runner
-        async with httpx.AsyncClient(timeout=300.0) as http_client:
-            response = await http_client.post(
-                f"{SEI_RUNNER_URL}/run-blocos",
-                json=payload
-            )
-            data = response.json()
+        response = await post_sei_runner("/run-blocos", payload, timeout=300.0)
+        data = response.json()
         
         # Processa resposta
         if data.get("ok") == False and not data.get("json_data"):
@@ -1272,14 +1340,9 @@ async def chamar_blocos_runner(acao: str, usuario_sei: str, credenciais: Optiona
             return data["json_data"]
         
         # Tenta parsear do output
-        output = data.get("output", "")
-        import re
-        json_match = re.search(r'\{[\s\S]*"sucesso"[\s\S]*\}', output)
-        if json_match:
-            try:
-                return json.loads(json_match.group())
-            except json.JSONDecodeError:
-                pass
+        resultado = extrair_json_sucesso(data.get("output", "") or "")
+        if resultado:
+            return resultado
         
         return {"sucesso": False, "erro": "Não foi possível processar resposta"}
         
@@ -3,11 +3,18 @@
 laravel_integration.py v3.1 - COM ANíLISE IA + JSON COMPLETO
 Fluxo: detalhar_processo (--full) -> Agente IA -> JSON estruturado com documentos
 """
-import os, sys, json, re, time
-from typing import Optional, Dict, List
+import os, sys, json, re, time, math, heapq, asyncio, hashlib
+import logging, logging.handlers, queue
+from typing import Optional, Dict, List, Union
 from pathlib import Path
+from functools import lru_cache
+from collections import OrderedDict, Counter
+from dataclasses import dataclass
 from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse
 import httpx
+import openai
+import orjson
 from typing import List
 
 sys.path.insert(0, '/app/scripts')
@@ -38,6 +45,30 @@ except ImportError as e:
     PIPELINE_V2_DISPONIVEL = False
     print(f"[INIT] Pipeline v2 nao disponivel: {e}", file=sys.stderr)
 
+# Aho-Corasick (pyahocorasick) para as âncoras do scoring do RAG
+try:
+    import ahocorasick
+    AHOCORASICK_DISPONIVEL = True
+except ImportError:
+    AHOCORASICK_DISPONIVEL = False
+    print("[INIT] pyahocorasick nao disponivel, scoring usa busca por substring", file=sys.stderr)
+
+# HTTP/2 (pacote h2) para os serviços externos em HTTPS
+try:
+    import h2  # noqa: F401
+    HTTP2_DISPONIVEL = True
+except ImportError:
+    HTTP2_DISPONIVEL = False
+    print("[INIT] h2 nao disponivel, clientes HTTP usam HTTP/1.1", file=sys.stderr)
+
+# Descriptografia das senhas SEI salvas pelo Laravel (AES-256-GCM)
+try:
+    from decrypt_laravel import decrypt_laravel_aes_gcm
+    DECRYPT_DISPONIVEL = True
+except ImportError as e:
+    DECRYPT_DISPONIVEL = False
+    print(f"[INIT] decrypt_laravel nao disponivel: {e}", file=sys.stderr)
+
 SEI_RUNNER_URL = os.getenv("SEI_RUNNER_URL", "http://runner:8001")
 DETALHAR_WORKER_URL = os.getenv("DETALHAR_WORKER_URL", "http://plattargus-detalhar-worker:8102")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
@@ -49,6 +80,66 @@ USAR_DETALHAR_WORKER = os.getenv("USAR_DETALHAR_WORKER", "true").lower() == "tru
 EFETIVO_API_URL = os.getenv("EFETIVO_API_URL", "https://efetivo.gt2m58.cloud")
 EFETIVO_API_KEY = os.getenv("EFETIVO_API_KEY", "gw_PlattArgusWeb2025_CBMAC")
 
+# Máximo de chamadas simultâneas ao SEI Runner (as demais aguardam na fila)
+SEI_RUNNER_CONCURRENCY = int(os.getenv("SEI_RUNNER_CONCURRENCY", "16"))
+
+# Cache de respostas do LLM (chat / melhorar-texto), em segundos
+CACHE_LLM_TTL = int(os.getenv("CACHE_LLM_TTL", "86400"))
+CACHE_N8N_TTL = int(os.getenv("CACHE_N8N_TTL", "900"))
+CACHE_CREDENCIAL_TTL = int(os.getenv("CACHE_CREDENCIAL_TTL", "300"))
+CACHE_RAG_TTL = int(os.getenv("CACHE_RAG_TTL", "3600"))
+CACHE_MILITAR_BUSCA_TTL = int(os.getenv("CACHE_MILITAR_BUSCA_TTL", "60"))
+CACHE_MILITAR_TTL = int(os.getenv("CACHE_MILITAR_TTL", "300"))
+
+# Rerank BM25 dos candidatos do RAG (0 = desligado; 0.6 = 60% BM25 + 40% âncoras)
+RAG_BM25_PESO = float(os.getenv("RAG_BM25_PESO", "0"))
+
+# Quanto a análise espera pela legislação do n8n antes de seguir sem ela (s)
+LEGISLACAO_TIMEOUT_ANALISE = float(os.getenv("LEGISLACAO_TIMEOUT_ANALISE", "8"))
+# Quanto os chats, que são interativos, esperam pela legislação (s): o n8n no
+# /api/processos/chat e o ChromaDB local no /api/chat (api.py)
+LEGISLACAO_TIMEOUT_CHAT = float(os.getenv("LEGISLACAO_TIMEOUT_CHAT", "2"))
+
+# Nível do logger do módulo (DEBUG, INFO, WARNING...)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# ============================================================
+# LOGGING
+# Os handlers enfileiram o registro; a escrita em stderr fica na
+# thread do QueueListener, fora do caminho das requisições.
+# ============================================================
+
+logger = logging.getLogger("laravel_integration")
+_log_fila = queue.SimpleQueue()
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_log_handler: Optional[logging.handlers.QueueHandler] = None
+
+
+def configurar_logger():
+    """Liga o logger do módulo à fila + listener (idempotente)"""
+    global _log_listener, _log_handler
+    if _log_listener is not None:
+        return
+    saida = logging.StreamHandler(sys.stderr)
+    saida.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+    _log_listener = logging.handlers.QueueListener(_log_fila, saida)
+    _log_listener.start()
+    _log_handler = logging.handlers.QueueHandler(_log_fila)
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def parar_logger():
+    """Desliga o handler da fila, esvazia a fila e para o listener (shutdown do app)"""
+    global _log_listener, _log_handler
+    if _log_handler is not None:
+        logger.removeHandler(_log_handler)
+        _log_handler = None
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
 # ============================================================
 # MODELOS
 # ============================================================
@@ -107,68 +198,549 @@ class AssinarSEIRequest(BaseModel):
     user_id: Optional[int] = None
     modo: Optional[str] = "assinar"
 
+class ChatRequest(BaseModel):
+    mensagem: Optional[str] = ""
+    texto_canonico: Optional[str] = ""
+    modelo_forcado: Optional[str] = "gpt-4.1-mini"
+    user_id: Optional[Union[int, str]] = None
+    stream: bool = False
+
+class AnalisarComCredenciaisDBRequest(BaseModel):
+    nup: Optional[str] = None
+    usuario_sei: Optional[str] = None
+
 # ============================================================
 # FUNííES AUXILIARES
 # ============================================================
 
 
+# Padrões de limpar_html_para_sei, fundidos em uma alternância para uma
+# única varredura (compilada uma vez no import). A ordem das alternativas
+# preserva a prioridade das antigas passadas sequenciais.
+RE_SEI_NUP_TIPO = re.compile(
+    # 1. Bloco completo com NUP e Tipo em um <p>
+    r'(?s:<p[^>]*>\s*[•\-]?\s*NUP\s*:\s*[\d\.\-/]+.*?</p>\s*)'
+    # 2. Linha separada só com Tipo de documento
+    r'|<p[^>]*>\s*[•\-]?\s*Tipo\s*(?:de\s*)?documento\s*:\s*[^<]+</p>\s*'
+    # 3. Dentro de um <p> com <br>, só as linhas de NUP/Tipo
+    r'|[•\-]?\s*NUP\s*:\s*[\d\.\-/]+\s*<br\s*/?>'
+    r'|[•\-]?\s*Tipo\s*(?:de\s*)?documento\s*:\s*[^<]+<br\s*/?>'
+    # 4. <hr> separador que fica após o bloco NUP/Tipo
+    r'|<hr[^>]*>\s*',
+    re.IGNORECASE
+)
+# Parágrafos vazios
+RE_P_VAZIO = re.compile(r'<p[^>]*>\s*</p>')
+
+# NUP que o LLM possa ter gerado no corpo (parágrafo inteiro ou linha com <br>)
+RE_CORPO_NUP = re.compile(
+    r'(?s:<p[^>]*>\s*[•\-]?\s*NUP\s*:\s*[\d\.\-/]+.*?</p>\s*)'
+    r'|[•\-]?\s*NUP\s*:\s*[\d\.\-/]+\s*<br\s*/?>',
+    re.IGNORECASE
+)
+
+
 def limpar_html_para_sei(html: str) -> str:
     """
     Remove o bloco de NUP e Tipo de Documento do corpo HTML antes de enviar ao SEI.
     O SEI já possui esses dados como metadados, então não devem aparecer no corpo.
     """
-    # Padrão 1: Bloco completo com NUP e Tipo em um <p>
-    padrao_bloco = re.compile(
-        r'<p[^>]*>\s*[•\-]?\s*NUP\s*:\s*[\d\.\-/]+.*?</p>\s*',
-        re.IGNORECASE | re.DOTALL
-    )
-    html = padrao_bloco.sub('', html)
+    html = RE_SEI_NUP_TIPO.sub('', html)
 
-    # Padrão 2: Linha separada só com NUP
-    padrao_nup = re.compile(
-        r'<p[^>]*>\s*[•\-]?\s*NUP\s*:\s*[\d\.\-/]+\s*</p>\s*',
-        re.IGNORECASE
-    )
-    html = padrao_nup.sub('', html)
+    # Remove parágrafos vazios que sobraram
+    html = RE_P_VAZIO.sub('', html)
 
-    # Padrão 3: Linha separada só com Tipo de documento
-    padrao_tipo = re.compile(
-        r'<p[^>]*>\s*[•\-]?\s*Tipo\s*(de\s*)?documento\s*:\s*[^<]+</p>\s*',
-        re.IGNORECASE
-    )
-    html = padrao_tipo.sub('', html)
+    # Remove espaços em branco extras no início
+    html = html.lstrip()
 
-    # Padrão 4: Dentro de um <p> com <br>, remove só as linhas de NUP/Tipo
-    padrao_linha_nup = re.compile(
-        r'[•\-]?\s*NUP\s*:\s*[\d\.\-/]+\s*<br\s*/?>',
-        re.IGNORECASE
-    )
-    html = padrao_linha_nup.sub('', html)
+    return html
+
+RE_PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+# Cercas de markdown (```json, ```html ou ```) nas respostas do modelo
+RE_FENCE = re.compile(r'```(?:json|html)?\s*')
+
+# Número do BG citado na instrução de voz (termo de encerramento)
+RE_NUMERO_BG = re.compile(r'BG\s*n?[º°]?\s*(\d+[/-]?\d*)', re.IGNORECASE)
+
+_json_decoder = json.JSONDecoder()
+
+
+def extrair_json_sucesso(output: str) -> Optional[dict]:
+    """
+    Extrai o JSON de resultado ({... "sucesso" ...}) do stdout de um script.
+    Mesmo trecho que r'\{[\s\S]*"sucesso"[\s\S]*\}' (primeiro '{' até o
+    último '}'), mas com find/rfind em vez de regex com backtracking.
+    """
+    i = output.find('{')
+    if i == -1:
+        return None
+    k = output.find('"sucesso"', i + 1)
+    j = output.rfind('}')
+    if k == -1 or j < k + len('"sucesso"'):
+        return None
+    try:
+        return json.loads(output[i:j + 1])
+    except ValueError:
+        pass
+    # Log com chaves antes/depois do JSON: decodifica a partir do '{'
+    # mais próximo antes de "sucesso"
+    i = output.rfind('{', 0, k)
+    if i != -1:
+        try:
+            obj = _json_decoder.raw_decode(output, i)[0]
+        except ValueError:
+            return None
+        if isinstance(obj, dict) and "sucesso" in obj:
+            return obj
+    return None
+
+
+def extrair_objeto_json(texto: str) -> Optional[str]:
+    """
+    Retorna o primeiro objeto JSON balanceado ({...}) embutido no texto,
+    contando chaves fora de strings em uma única passada.
+    """
+    inicio = texto.find('{')
+    if inicio == -1:
+        return None
+    profundidade = 0
+    em_string = False
+    escape = False
+    for pos in range(inicio, len(texto)):
+        c = texto[pos]
+        if em_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                em_string = False
+        elif c == '"':
+            em_string = True
+        elif c == "{":
+            profundidade += 1
+        elif c == "}":
+            profundidade -= 1
+            if profundidade == 0:
+                return texto[inicio:pos + 1]
+    return None
+
+
+# ============================================================
+# CLIENTES COMPARTILHADOS (HTTP, OPENAI, POSTGRESQL)
+# Um pool de conexões por destino, reaproveitado entre requisições
+# e fechado no shutdown do app (ver registrar_endpoints_laravel).
+# ============================================================
+
+_cliente_sei: Optional[httpx.AsyncClient] = None
+
+
+def obter_cliente_sei() -> httpx.AsyncClient:
+    """Cliente HTTP compartilhado para o SEI Runner (keep-alive entre chamadas)"""
+    global _cliente_sei
+    if _cliente_sei is None or _cliente_sei.is_closed:
+        _cliente_sei = httpx.AsyncClient(
+            base_url=SEI_RUNNER_URL,
+            timeout=httpx.Timeout(300.0),
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=30
+            )
+        )
+    return _cliente_sei
+
+
+_cliente_http: Optional[httpx.AsyncClient] = None
+
+
+def obter_cliente_http() -> httpx.AsyncClient:
+    """
+    Cliente HTTP compartilhado para os demais serviços (Detalhar Worker, n8n,
+    RAG de leis, API de Efetivo). Cada chamada informa o seu próprio timeout.
+    Com h2 instalado, os destinos HTTPS (Efetivo) negociam HTTP/2 e
+    multiplexam as requisições simultâneas numa mesma conexão.
+    """
+    global _cliente_http
+    if _cliente_http is None or _cliente_http.is_closed:
+        _cliente_http = httpx.AsyncClient(
+            http2=HTTP2_DISPONIVEL,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(
+                max_connections=64,
+                max_keepalive_connections=32,
+                keepalive_expiry=30
+            )
+        )
+    return _cliente_http
+
+
+_sei_semaforo = asyncio.Semaphore(SEI_RUNNER_CONCURRENCY)
+
+# Corpos JSON enviados já serializados com orjson (content=), em vez do json= do httpx
+HEADERS_JSON = {"Content-Type": "application/json"}
+
+
+async def post_sei_runner(caminho: str, payload: dict, timeout: float = None) -> httpx.Response:
+    """POST no SEI Runner pelo cliente compartilhado, limitado por SEI_RUNNER_CONCURRENCY"""
+    kwargs = {"content": orjson.dumps(payload), "headers": HEADERS_JSON}
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    async with _sei_semaforo:
+        return await obter_cliente_sei().post(caminho, **kwargs)
 
-    padrao_linha_tipo = re.compile(
-        r'[•\-]?\s*Tipo\s*(de\s*)?documento\s*:\s*[^<]+<br\s*/?>',
-        re.IGNORECASE
+
+def resultado_run_sei(response: httpx.Response, erro_padrao: str) -> Dict:
+    """
+    Converte a resposta do /run do SEI Runner no resultado do script
+    (json_data) ou num {"sucesso": False, ...}. Corpo vazio ou que não é JSON
+    (ex.: 502 do proxy) vira erro com o status HTTP, sem exceção.
+    """
+    try:
+        data = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return {"sucesso": False, "erro": f"SEI Runner HTTP {response.status_code}: {response.text[:500]}"}
+
+    if not data.get("ok"):
+        return {"sucesso": False, "erro": data.get("error", erro_padrao)}
+
+    # Usa json_data parseado pelo Runner (stdout do script)
+    json_data = data.get("json_data")
+    if json_data and isinstance(json_data, dict):
+        return json_data
+
+    # Fallback: retorna erro com output para diagnóstico
+    output = data.get("output", "")
+    return {"sucesso": False, "erro": "Não foi possível extrair resultado do script", "output": output[:1000]}
+
+
+_pool_pg = None
+_pool_pg_lock = asyncio.Lock()
+
+
+async def obter_pool_pg():
+    """Pool asyncpg do banco do Laravel (criado na primeira chamada)"""
+    global _pool_pg
+    if _pool_pg is None:
+        async with _pool_pg_lock:
+            if _pool_pg is None:
+                import asyncpg
+                _pool_pg = await asyncpg.create_pool(
+                    host=os.getenv("DB_HOST", "plattargus-db"),
+                    port=int(os.getenv("DB_PORT", "5432")),
+                    database=os.getenv("DB_DATABASE", "plattargus_web"),
+                    user=os.getenv("DB_USERNAME", "plattargus_web"),
+                    password=os.getenv("DB_PASSWORD", ""),
+                    min_size=2,
+                    max_size=20
+                )
+    return _pool_pg
+
+
+async def fechar_clientes_http():
+    """Fecha os clientes compartilhados (chamado no shutdown do app)"""
+    global _cliente_sei, _cliente_http, _pool_pg
+    if _cliente_sei is not None:
+        await _cliente_sei.aclose()
+        _cliente_sei = None
+    if _cliente_http is not None:
+        await _cliente_http.aclose()
+        _cliente_http = None
+    if _pool_pg is not None:
+        await _pool_pg.close()
+        _pool_pg = None
+    if obter_cliente_openai.cache_info().currsize:
+        await obter_cliente_openai().close()
+        obter_cliente_openai.cache_clear()
+
+
+@lru_cache(maxsize=1)
+def obter_cliente_openai() -> "openai.AsyncOpenAI":
+    """
+    Cliente OpenAI assíncrono compartilhado pelo módulo (reaproveita o pool
+    de conexões entre chamadas). Criado na primeira chamada.
+    """
+    return openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=2,
+        timeout=httpx.Timeout(60.0, connect=5.0)
     )
-    html = padrao_linha_tipo.sub('', html)
 
-    # Remove <hr> separador que fica após o bloco NUP/Tipo
-    html = re.sub(r'<hr[^>]*>\s*', '', html)
 
-    # Remove parágrafos vazios que sobraram
-    html = re.sub(r'<p[^>]*>\s*</p>', '', html)
+# ============================================================
+# CACHE EM MEMÓRIA (LRU + TTL)
+# ============================================================
 
-    # Remove espaços em branco extras no início
-    html = html.lstrip()
+# Resultado entregue a quem espera quando a consulta em andamento é cancelada
+_CONSULTA_CANCELADA = object()
+
+
+class CacheTTL:
+    """
+    Cache LRU com expiração por tempo, local ao processo.
+    Usado para respostas repetidas (mesma pergunta, mesmo contexto).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._dados = OrderedDict()
+        self._pendentes = {}
+
+    def get(self, chave):
+        item = self._dados.get(chave)
+        if item is None:
+            return None
+        expira_em, valor = item
+        if expira_em < time.monotonic():
+            del self._dados[chave]
+            return None
+        self._dados.move_to_end(chave)
+        return valor
+
+    def set(self, chave, valor):
+        self._dados[chave] = (time.monotonic() + self.ttl, valor)
+        self._dados.move_to_end(chave)
+        while len(self._dados) > self.maxsize:
+            self._dados.popitem(last=False)
+
+    def descartar(self, chave):
+        self._dados.pop(chave, None)
+
+    def clear(self):
+        self._dados.clear()
+
+    async def obter_ou_calcular(self, chave, calcular, cachear=None):
+        """
+        Retorna o valor em cache ou aguarda `calcular()` (corrotina).
+        Chamadas simultâneas para a mesma chave aguardam o mesmo Future
+        (single-flight): uma consulta só, e todas recebem o mesmo resultado,
+        mesmo quando ele não é guardado. Se a requisição que faz a consulta
+        for cancelada, quem espera refaz a consulta em vez de receber o
+        cancelamento. `cachear(valor)` decide se o resultado é guardado.
+        """
+        while True:
+            valor = self.get(chave)
+            if valor is not None:
+                return valor
+            pendente = self._pendentes.get(chave)
+            if pendente is None:
+                break
+            # shield: cancelar quem espera não cancela a consulta dos demais
+            valor = await asyncio.shield(pendente)
+            if valor is not _CONSULTA_CANCELADA:
+                return valor
+            # A requisição que fazia a consulta foi cancelada (ex.: cliente
+            # desconectou): uma das que esperavam assume a consulta
+
+        pendente = asyncio.get_running_loop().create_future()
+        self._pendentes[chave] = pendente
+        try:
+            valor = await calcular()
+        except asyncio.CancelledError:
+            del self._pendentes[chave]
+            pendente.set_result(_CONSULTA_CANCELADA)
+            raise
+        except Exception as e:
+            pendente.set_exception(e)
+            pendente.exception()  # evita o aviso de exceção não lida sem espera
+            raise
+        else:
+            if cachear is None or cachear(valor):
+                self.set(chave, valor)
+            pendente.set_result(valor)
+            return valor
+        finally:
+            if self._pendentes.get(chave) is pendente:
+                del self._pendentes[chave]
+
+
+def chave_cache(*partes) -> str:
+    """Chave estável (sha1) para o cache a partir das partes (sem espaços nas pontas)"""
+    h = hashlib.sha1()
+    for parte in partes:
+        h.update(str(parte).strip().encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def normalizar_consulta(texto: str) -> str:
+    """Pergunta em minúsculas e com espaços colapsados (para chaves de cache)"""
+    return " ".join(texto.lower().split())
+
+
+# Respostas do LLM por (modelo, prompt de sistema, mensagem)
+cache_respostas_llm = CacheTTL(maxsize=1024, ttl=CACHE_LLM_TTL)
+
+# Respostas do webhook de legislação (n8n) por pergunta normalizada
+cache_legislacao_n8n = CacheTTL(maxsize=2048, ttl=CACHE_N8N_TTL)
+
+# Trechos de legislação do RAG por (tópico, intenção, pergunta normalizada)
+cache_legislacao_rag = CacheTTL(maxsize=512, ttl=CACHE_RAG_TTL)
+
+# API de Efetivo: autocomplete por (termo normalizado, limite) e militar por matrícula
+cache_militar_busca = CacheTTL(maxsize=2048, ttl=CACHE_MILITAR_BUSCA_TTL)
+cache_militar = CacheTTL(maxsize=4096, ttl=CACHE_MILITAR_TTL)
+
+# Credenciais SEI já descriptografadas, por usuario_sei
+cache_credenciais_sei = CacheTTL(maxsize=1024, ttl=CACHE_CREDENCIAL_TTL)
+
+
+class RespostaORJSON(JSONResponse):
+    """JSONResponse serializada com orjson (respostas grandes: documentos, RAG)"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+# ============================================================
+# STREAMING (SSE) DAS RESPOSTAS DO LLM
+# ============================================================
+
+SSE_FIM = b"data: [DONE]\n\n"
+
+
+def evento_sse(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
 
-    return html
 
+class FiltroStreamTexto:
+    """
+    Aplica aos deltas de um stream a mesma limpeza da resposta completa:
+    RE_FENCE.sub('', texto).strip() (ou só strip() com remover_cercas=False).
+    Retém o fim de cada delta que ainda pode virar uma cerca (``` seguido de
+    json/html e espaços) ou espaço final, até o próximo delta confirmar.
+    """
+
+    def __init__(self, remover_cercas: bool = True):
+        self.remover_cercas = remover_cercas
+        self._pendente = ""   # texto bruto ainda não processado
+        self._espacos = ""    # espaços já processados, retidos no fim
+        self._iniciado = False
+
+    def _limpar(self, texto: str) -> str:
+        return RE_FENCE.sub('', texto) if self.remover_cercas else texto
+
+    def _corte_seguro(self, texto: str) -> int:
+        """Até onde `texto` já pode ser limpo sem depender do próximo delta"""
+        if not self.remover_cercas:
+            return len(texto)
+        fim = len(texto.rstrip('`'))
+        if fim < len(texto):
+            return fim
+        ultima = None
+        for ultima in RE_FENCE.finditer(texto):
+            pass
+        if ultima is not None:
+            resto = texto[ultima.end():]
+            if not resto or "json".startswith(resto) or "html".startswith(resto):
+                return ultima.start()
+        return len(texto)
+
+    def _emitir(self, limpo: str) -> str:
+        if not self._iniciado:
+            limpo = limpo.lstrip()
+            if not limpo:
+                return ""
+            self._iniciado = True
+        corpo = limpo.rstrip()
+        if not corpo:
+            self._espacos += limpo
+            return ""
+        saida = self._espacos + corpo
+        self._espacos = limpo[len(corpo):]
+        return saida
+
+    def alimentar(self, delta: str) -> str:
+        texto = self._pendente + delta
+        corte = self._corte_seguro(texto)
+        self._pendente = texto[corte:]
+        return self._emitir(self._limpar(texto[:corte]))
+
+    def finalizar(self) -> str:
+        texto, self._pendente = self._pendente, ""
+        return self._emitir(self._limpar(texto))
+
+
+async def eventos_sse_openai(stream, ao_concluir=None, filtro: FiltroStreamTexto = None):
+    """
+    Repassa os deltas de um stream do chat.completions como eventos SSE
+    ({"delta": ...}), limpos por `filtro` quando informado. Ao final chama
+    `ao_concluir(texto_completo)` com o texto efetivamente enviado.
+    """
+    partes = []
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta and filtro:
+                delta = filtro.alimentar(delta)
+            if delta:
+                partes.append(delta)
+                yield evento_sse({"delta": delta})
+        if filtro:
+            delta = filtro.finalizar()
+            if delta:
+                partes.append(delta)
+                yield evento_sse({"delta": delta})
+        if ao_concluir:
+            ao_concluir("".join(partes))
+    except Exception as e:
+        logger.error("[SSE] Erro no stream: %s", e)
+        yield evento_sse({"erro": str(e)})
+    finally:
+        await stream.close()
+    yield SSE_FIM
+
+
+async def eventos_sse_texto(texto: str, cache: bool = True):
+    """Resposta já pronta (ex.: cache) no mesmo formato SSE"""
+    yield evento_sse({"delta": texto, "cache": True} if cache else {"delta": texto})
+    yield SSE_FIM
+
+
+def resposta_sse(eventos) -> StreamingResponse:
+    return StreamingResponse(
+        eventos,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def preencher_placeholders(template: str, valores: dict) -> str:
+    """
+    Substitui os {placeholders} conhecidos em uma única passada.
+    Chaves ausentes em `valores` (e o escape {{ }} dos exemplos JSON) ficam intactas.
+    """
+    def _valor(m):
+        chave = m.group(1)
+        return str(valores[chave]) if chave in valores else m.group(0)
+    return RE_PLACEHOLDER.sub(_valor, template)
+
+@lru_cache(maxsize=64)
 def carregar_prompt(nome: str) -> str:
-    """Carrega prompt do arquivo"""
+    """Carrega prompt do arquivo (lido do disco só na primeira chamada)"""
     path = PROMPTS_DIR / f"{nome}.txt"
     if path.exists():
         return path.read_text(encoding='utf-8')
     return ""
 
+# Instruções fixas do chat (/api/processos/chat). Ficam em uma mensagem de sistema
+# própria, idêntica entre chamadas, para aproveitar o cache de prefixo da
+# OpenAI; legislação e contexto do processo vão numa segunda mensagem.
+ARGUS_SYSTEM_PROMPT = """Você é o ARGUS, assistente inteligente do CBMAC (Corpo de Bombeiros Militar do Acre).
+
+Sua função é auxiliar na análise de processos administrativos, responder dúvidas sobre legislação e ajudar na redação de documentos.
+
+REGRAS:
+- Use linguagem formal administrativa
+- Cite a legislação quando relevante
+- Seja objetivo e claro
+- Se não souber, diga que não sabe
+- Use HTML para formatação: <b>, <i>, <p>, <br>, <ul>, <li>"""
+
 async def chamar_sei_reader_com_credencial(nup: str, credencial: CredencialSEI) -> Dict:
     """
     Extrai e analisa processo do SEI.
@@ -182,24 +754,31 @@ async def chamar_sei_reader_com_credencial(nup: str, credencial: CredencialSEI)
     # Tenta usar o Worker com /process-now (já tem Pipeline v2 integrado)
     if USAR_DETALHAR_WORKER:
         try:
-            print(f"   📖 Usando Detalhar Worker /process-now...", file=sys.stderr)
-            async with httpx.AsyncClient(timeout=600.0) as client:
-                response = await client.post(
-                    f"{DETALHAR_WORKER_URL}/process-now",
-                    json={
-                        "nup": nup,
-                        "usuario": credencial.usuario,
-                        "senha": credencial.senha,
-                        "orgao_id": credencial.orgao_id
-                    }
-                )
-                data = response.json()
+            logger.info("   usando Detalhar Worker /process-now...")
+            response = await obter_cliente_http().post(
+                f"{DETALHAR_WORKER_URL}/process-now",
+                content=orjson.dumps({
+                    "nup": nup,
+                    "usuario": credencial.usuario,
+                    "senha": credencial.senha,
+                    "orgao_id": credencial.orgao_id
+                }),
+                headers=HEADERS_JSON,
+                timeout=600.0
+            )
+            data = orjson.loads(response.content)
 
             if data.get("status") == "ok":
                 duracao = time.time() - t0
                 from_cache = data.get("from_cache", False)
                 cache_info = " (CACHE)" if from_cache else ""
-                print(f"   ✓ Worker OK{cache_info} em {duracao:.1f}s", file=sys.stderr)
+                logger.info("   Worker OK%s em %.1fs", cache_info, duracao)
+
+                # Campos repetidos no topo e em "analise"
+                resumo = data.get("resumo_texto", "")
+                interessado = data.get("interessado") or {}
+                pedido = data.get("pedido") or {}
+                situacao = data.get("situacao") or {}
 
                 # Montar resultado no formato esperado
                 return {
@@ -209,26 +788,26 @@ async def chamar_sei_reader_com_credencial(nup: str, credencial: CredencialSEI)
                     "from_cache": from_cache,
                     "fonte": "detalhar-worker-cache" if from_cache else "detalhar-worker",
                     "job_id": data.get("job_id"),
-                    "resumo_processo": data.get("resumo_texto", ""),
-                    "resumo_executivo": data.get("resumo_texto", ""),
-                    "interessado": data.get("interessado") or {},
-                    "pedido": data.get("pedido") or {},
-                    "situacao": data.get("situacao") or {},
+                    "resumo_processo": resumo,
+                    "resumo_executivo": resumo,
+                    "interessado": interessado,
+                    "pedido": pedido,
+                    "situacao": situacao,
                     "analise": {
-                        "interessado": data.get("interessado") or {},
-                        "pedido": data.get("pedido") or {},
-                        "situacao": data.get("situacao") or {},
+                        "interessado": interessado,
+                        "pedido": pedido,
+                        "situacao": situacao,
                         "confianca": data.get("confianca", 0),
-                        "resumo_executivo": data.get("resumo_texto", "")
+                        "resumo_executivo": resumo
                     },
                     "metricas_pipeline": data.get("metricas") or {},
                     "duracao_total": duracao
                 }
             else:
-                print(f"   ⚠ Worker erro: {data.get('erro')}, tentando fallback...", file=sys.stderr)
+                logger.warning("   Worker erro: %s, tentando fallback...", data.get('erro'))
 
         except Exception as e:
-            print(f"   ⚠ Worker indisponivel: {e}, tentando fallback...", file=sys.stderr)
+            logger.warning("   Worker indisponivel: %s, tentando fallback...", e)
 
     # Fallback: SEI Runner + Pipeline v2 local
     return await chamar_sei_reader_fallback(nup, credencial)
@@ -244,22 +823,21 @@ async def chamar_sei_reader_fallback(nup: str, credencial: CredencialSEI) -> Dic
 
     try:
         # 1. EXTRACAO via SEI Runner
-        print(f"   [1/2] Extraindo via SEI Runner (fallback)...", file=sys.stderr)
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(
-                f"{SEI_RUNNER_URL}/run",
-                json={
-                    "mode": "detalhar",
-                    "nup": nup,
-                    "credentials": {
-                        "usuario": credencial.usuario,
-                        "senha": credencial.senha,
-                        "orgao_id": credencial.orgao_id
-                    },
-                    "full": True
-                }
-            )
-            data = response.json()
+        logger.info("   [1/2] Extraindo via SEI Runner (fallback)...")
+        response = await post_sei_runner(
+            "/run",
+            {
+                "mode": "detalhar",
+                "nup": nup,
+                "credentials": {
+                    "usuario": credencial.usuario,
+                    "senha": credencial.senha,
+                    "orgao_id": credencial.orgao_id
+                },
+                "full": True
+            }
+        )
+        data = orjson.loads(response.content)
 
         if not data.get("ok"):
             return {"sucesso": False, "erro": data.get("error", "Erro desconhecido"), "nup": nup}
@@ -269,13 +847,7 @@ async def chamar_sei_reader_fallback(nup: str, credencial: CredencialSEI) -> Dic
         if data.get("json_data"):
             resultado = data["json_data"]
         else:
-            output = data.get("output", "")
-            json_match = re.search(r'\{[\s\S]*"sucesso"[\s\S]*\}', output)
-            if json_match:
-                try:
-                    resultado = json.loads(json_match.group())
-                except:
-                    pass
+            resultado = extrair_json_sucesso(data.get("output", "") or "")
 
         if not resultado:
             return {"sucesso": True, "nup": nup, "resumo_processo": data.get("output", "")[:8000]}
@@ -285,11 +857,11 @@ async def chamar_sei_reader_fallback(nup: str, credencial: CredencialSEI) -> Dic
         documentos = resultado.get("documentos", [])
 
         duracao_extracao = time.time() - t0
-        print(f"   ✓ SEI extraido: {len(str(resultado))} chars, {len(documentos)} docs ({duracao_extracao:.1f}s)", file=sys.stderr)
+        logger.info("   SEI extraido: %d chars, %d docs (%.1fs)", len(str(resultado)), len(documentos), duracao_extracao)
 
         # 2. PIPELINE v2 (se disponivel e ativado)
         if PIPELINE_V2_DISPONIVEL and USAR_PIPELINE_V2 and documentos:
-            print(f"   [2/2] Analisando com Pipeline v2 local...", file=sys.stderr)
+            logger.info("   [2/2] Analisando com Pipeline v2 local...")
             try:
                 analise = processar_pipeline_v2(nup, documentos, usar_llm=True)
 
@@ -307,25 +879,25 @@ async def chamar_sei_reader_fallback(nup: str, credencial: CredencialSEI) -> Dic
                     resultado["resumo_processo"] = formatar_analise_para_contexto(analise)
 
                     custo = analise.get("metricas", {}).get("custo_total_usd", 0)
-                    print(f"   ✓ Pipeline v2 OK! Custo: ${custo:.4f}", file=sys.stderr)
+                    logger.info("   Pipeline v2 OK! Custo: $%.4f", custo)
                 else:
-                    print(f"   ⚠ Pipeline v2 falhou: {analise.get('erro')}", file=sys.stderr)
+                    logger.warning("   Pipeline v2 falhou: %s", analise.get('erro'))
                     resultado["pipeline_v2"] = False
                     resultado["pipeline_erro"] = analise.get("erro")
             except Exception as e:
-                print(f"   ⚠ Erro no Pipeline v2: {e}", file=sys.stderr)
+                logger.warning("   Erro no Pipeline v2: %s", e)
                 resultado["pipeline_v2"] = False
                 resultado["pipeline_erro"] = str(e)
         else:
             resultado["pipeline_v2"] = False
 
         resultado["duracao_total"] = time.time() - t0
-        print(f"   ✓ Fallback completo em {resultado['duracao_total']:.1f}s", file=sys.stderr)
+        logger.info("   Fallback completo em %.1fs", resultado['duracao_total'])
 
         return resultado
 
     except Exception as e:
-        print(f"   ✗ Erro fallback: {e}", file=sys.stderr)
+        logger.error("   Erro fallback: %s", e)
         return {"sucesso": False, "erro": str(e), "nup": nup}
 
 
@@ -334,47 +906,103 @@ async def chamar_sei_reader_fallback(nup: str, credencial: CredencialSEI) -> Dic
 # Adaptado do n8n para FastAPI
 # ============================================================
 
+class ConjuntoAncoras:
+    """
+    Conjunto de âncoras (palavra, bit) avaliado contra um texto, devolvendo o
+    OR dos bits encontrados. Com pyahocorasick é uma única varredura em C;
+    sem ele, um `in` por âncora.
+    """
+    __slots__ = ("pares", "automato")
+
+    def __init__(self, pares):
+        self.pares = tuple(pares)
+        self.automato = None
+        if AHOCORASICK_DISPONIVEL:
+            bits = {}
+            for palavra, bit in self.pares:
+                bits[palavra] = bits.get(palavra, 0) | bit
+            self.automato = ahocorasick.Automaton()
+            for palavra, bit in bits.items():
+                self.automato.add_word(palavra, bit)
+            self.automato.make_automaton()
+
+    def mascara(self, texto: str) -> int:
+        mask = 0
+        if self.automato is not None:
+            for _, bit in self.automato.iter(texto):
+                mask |= bit
+            return mask
+        for palavra, bit in self.pares:
+            if not mask & bit and palavra in texto:
+                mask |= bit
+        return mask
+
+
+# Palavras de cada assunto na pergunta -> bit HAS_*
+HAS_DISPENSA = 1 << 0
+HAS_RECOMPENSA = 1 << 1
+HAS_FERIAS = 1 << 2
+HAS_LICENCA = 1 << 3
+HAS_PROMOCAO = 1 << 4
+HAS_DISCIPLINAR = 1 << 5
+
+# Remove acentos (pergunta já em minúsculas) para testar uma grafia só
+SEM_ACENTO = str.maketrans("áàâãéêíóôõúüç", "aaaaeeiooouuc")
+
+# Âncoras sem acento: a pergunta passa por SEM_ACENTO antes
+ANCORAS_TOPIC = ConjuntoAncoras((
+    ("dispensa", HAS_DISPENSA),
+    ("recompensa", HAS_RECOMPENSA),
+    ("ferias", HAS_FERIAS),
+    ("promocao", HAS_PROMOCAO),
+    ("licenca", HAS_LICENCA),
+    ("disciplinar", HAS_DISCIPLINAR),
+    ("punicao", HAS_DISCIPLINAR),
+    ("transgress", HAS_DISCIPLINAR),
+))
+
+# Ordem de prioridade dos assuntos (recompensa sozinha não define tópico)
+_PRIORIDADE_TOPIC = (
+    (HAS_DISPENSA, "DISPENSA_RECOMPENSA"),
+    (HAS_FERIAS, "FERIAS"),
+    (HAS_PROMOCAO, "PROMOCAO"),
+    (HAS_LICENCA, "LICENCA"),
+    (HAS_DISCIPLINAR, "DISCIPLINAR"),
+)
+
+
+def _topic_da_mascara(mask: int) -> str:
+    for bit, topic in _PRIORIDADE_TOPIC:
+        if mask & bit:
+            return topic
+    return "GERAL"
+
+
+# Tabela mascara -> tópico (64 combinações), no lugar da cascata de if/elif
+_TOPIC_POR_MASCARA = tuple(_topic_da_mascara(m) for m in range(1 << 6))
+
+RE_INTENT_ANUAL = re.compile(r'\b(ano|anual|anuais|por ano|no ano|ao ano)\b')
+RE_INTENT_ININTERRUPTO = re.compile(r'\b(ininterrupt|consecutiv|seguid|continu)\b')
+RE_INTENT_LIMITE = re.compile(r'\b(quantos?\s+dias|limite|teto|maximo|nao\s+exceder|ultrapass)\b')
+
+
 def detectar_intent_e_topic(pergunta: str) -> dict:
     """
     Detecta a intenção (ANUAL, ININTERRUPTO, LIMITE, GERAL) 
     e o tí³pico (FERIAS, DISPENSA_RECOMPENSA, LICENCA, etc.)
     """
-    s = pergunta.lower()
+    s = pergunta.lower().translate(SEM_ACENTO)
     
     # --- TOPIC (assunto) ---
-    has_dispensa = "dispensa" in s
-    has_recompensa = "recompensa" in s
-    has_ferias = "férias" in s or "ferias" in s
-    has_promocao = "promoção" in s or "promocao" in s
-    has_licenca = "licença" in s or "licenca" in s
-    has_disciplinar = "disciplinar" in s or "punição" in s or "punicao" in s or "transgress" in s
-    
-    topic = "GERAL"
-    if has_dispensa and has_recompensa:
-        topic = "DISPENSA_RECOMPENSA"
-    elif has_dispensa:
-        topic = "DISPENSA_RECOMPENSA"
-    elif has_ferias:
-        topic = "FERIAS"
-    elif has_promocao:
-        topic = "PROMOCAO"
-    elif has_licenca:
-        topic = "LICENCA"
-    elif has_disciplinar:
-        topic = "DISCIPLINAR"
+    topic = _TOPIC_POR_MASCARA[ANCORAS_TOPIC.mascara(s)]
     
     # --- INTENT (tipo de pergunta) ---
-    import re
-    is_anual = bool(re.search(r'\b(ano|anual|anuais|por ano|no ano|ao ano)\b', s))
-    is_inint = bool(re.search(r'\b(ininterrupt|consecutiv|seguid|cont[ií]nu)\b', s))
-    is_limite = bool(re.search(r'\b(quantos?\s+dias|limite|teto|m[aá]ximo|n[aã]o\s+exceder|ultrapass)\b', s))
-    
     intent = "GERAL"
-    if is_anual:
+    if RE_INTENT_ANUAL.search(s):
         intent = "ANUAL"
-    elif is_inint:
+    elif RE_INTENT_ININTERRUPTO.search(s):
         intent = "ININTERRUPTO"
-    elif is_limite:
+    elif RE_INTENT_LIMITE.search(s):
         intent = "LIMITE"
     
     return {"topic": topic, "intent": intent}
@@ -422,113 +1050,335 @@ def reescrever_query(pergunta: str, topic: str, intent: str) -> tuple:
             return (f"CBMAC {pergunta}", 8)
 
 
-def calcular_score(resultado: dict, topic: str, intent: str) -> int:
+# ============================================================
+# SCORING DOS RESULTADOS DO RAG
+# As âncoras textuais viram bits de um inteiro (features) e a
+# pontuação é só aritmética inteira sobre esse bitmask.
+# ============================================================
+
+# IDs inteiros de tópico e intenção usados pelo kernel de pontuação
+TOPIC_GERAL = 0
+TOPIC_DISPENSA_RECOMPENSA = 1
+TOPIC_FERIAS = 2
+TOPIC_PROMOCAO = 3
+TOPIC_LICENCA = 4
+TOPIC_DISCIPLINAR = 5
+
+TOPIC_IDS = {
+    "GERAL": TOPIC_GERAL,
+    "DISPENSA_RECOMPENSA": TOPIC_DISPENSA_RECOMPENSA,
+    "FERIAS": TOPIC_FERIAS,
+    "PROMOCAO": TOPIC_PROMOCAO,
+    "LICENCA": TOPIC_LICENCA,
+    "DISCIPLINAR": TOPIC_DISCIPLINAR,
+}
+
+INTENT_GERAL = 0
+INTENT_ANUAL = 1
+INTENT_ININTERRUPTO = 2
+INTENT_LIMITE = 3
+
+INTENT_IDS = {
+    "GERAL": INTENT_GERAL,
+    "ANUAL": INTENT_ANUAL,
+    "ININTERRUPTO": INTENT_ININTERRUPTO,
+    "LIMITE": INTENT_LIMITE,
+}
+
+# Bits de features: F_LEI_* olham o metadado "lei", F_TXT_* o texto do resultado
+F_LEI_DISPENSA_RECOMPENSA = 1 << 0
+F_LEI_PORTARIA = 1 << 1
+F_LEI_078 = 1 << 2
+F_LEI_FERIAS = 1 << 3
+F_LEI_DISCIPLINAR = 1 << 4
+F_LEI_CONSTITUICAO = 1 << 5
+F_LEI_ORCAMENTO = 1 << 6
+F_TXT_DISPENSA = 1 << 7
+F_TXT_RECOMPENSA = 1 << 8
+F_TXT_FERIAS = 1 << 9
+F_TXT_GOZO_PERIODO = 1 << 10
+F_TXT_DISCIPLINAR = 1 << 11
+F_TXT_CBMAC = 1 << 12
+F_TXT_DIAS = 1 << 13
+F_TXT_ANO = 1 << 14
+F_TXT_LIMITE_ANUAL = 1 << 15
+F_TXT_ININTERRUPTO = 1 << 16
+F_TXT_LIMITE = 1 << 17
+F_TXT_NUMERO = 1 << 18
+F_TXT_MINISTERIO_PUBLICO = 1 << 19
+
+# Âncoras (palavra, bit). "78" cobre "078", "ano" cobre "por ano" e
+# "disciplinar" cobre "regulamento disciplinar".
+FEATURES_LEI = (
+    ("dispensa recompensa", F_LEI_DISPENSA_RECOMPENSA),
+    ("portaria", F_LEI_PORTARIA),
+    ("78", F_LEI_078),
+    ("férias", F_LEI_FERIAS),
+    ("ferias", F_LEI_FERIAS),
+    ("disciplinar", F_LEI_DISCIPLINAR),
+    ("constitui", F_LEI_CONSTITUICAO),
+    ("orçament", F_LEI_ORCAMENTO),
+)
+
+_FEATURES_TEXTO_TOPIC = {
+    TOPIC_DISPENSA_RECOMPENSA: (
+        ("dispensa", F_TXT_DISPENSA),
+        ("recompensa", F_TXT_RECOMPENSA),
+    ),
+    TOPIC_FERIAS: (
+        ("férias", F_TXT_FERIAS),
+        ("ferias", F_TXT_FERIAS),
+        ("gozo", F_TXT_GOZO_PERIODO),
+        ("período", F_TXT_GOZO_PERIODO),
+        ("periodo", F_TXT_GOZO_PERIODO),
+    ),
+    TOPIC_DISCIPLINAR: (
+        ("transgress", F_TXT_DISCIPLINAR),
+        ("puni", F_TXT_DISCIPLINAR),
+        ("penal", F_TXT_DISCIPLINAR),
+    ),
+}
+_FEATURES_TEXTO_GERAL = (("cbmac", F_TXT_CBMAC),)
+
+_FEATURES_TEXTO_INTENT = {
+    INTENT_ANUAL: (
+        ("ano", F_TXT_ANO),
+        ("anual", F_TXT_ANO),
+        ("limite", F_TXT_LIMITE_ANUAL),
+        ("máximo", F_TXT_LIMITE_ANUAL),
+        ("teto", F_TXT_LIMITE_ANUAL),
+        ("não poderá", F_TXT_LIMITE_ANUAL),
+        ("não exceder", F_TXT_LIMITE_ANUAL),
+        ("ultrapass", F_TXT_LIMITE_ANUAL),
+    ),
+    INTENT_ININTERRUPTO: (
+        ("ininterrupt", F_TXT_ININTERRUPTO),
+        ("consecut", F_TXT_ININTERRUPTO),
+        ("seguid", F_TXT_ININTERRUPTO),
+        ("contínuo", F_TXT_ININTERRUPTO),
+        ("continuo", F_TXT_ININTERRUPTO),
+    ),
+    INTENT_LIMITE: (
+        ("limite", F_TXT_LIMITE),
+        ("máximo", F_TXT_LIMITE),
+        ("teto", F_TXT_LIMITE),
+        ("não exceder", F_TXT_LIMITE),
+    ),
+}
+
+# Âncoras usadas só nas penalizações (tópico != GERAL)
+_FEATURES_TEXTO_PENALIDADE = (
+    ("dispensa", F_TXT_DISPENSA),
+    ("férias", F_TXT_FERIAS),
+    ("ferias", F_TXT_FERIAS),
+    ("ministério público", F_TXT_MINISTERIO_PUBLICO),
+)
+
+
+def _montar_features_texto(topic_id: int, intent_id: int) -> tuple:
+    """Junta as âncoras de texto necessárias para um par (tópico, intenção)."""
+    features = list(_FEATURES_TEXTO_TOPIC.get(topic_id, _FEATURES_TEXTO_GERAL))
+    features.append(("dias", F_TXT_DIAS))
+    features.extend(_FEATURES_TEXTO_INTENT.get(intent_id, ()))
+    if topic_id != TOPIC_GERAL:
+        features.extend(_FEATURES_TEXTO_PENALIDADE)
+    # Remove repetidas mantendo a ordem
+    return tuple(dict.fromkeys(features))
+
+
+# Só avalia as âncoras que o kernel vai consultar para cada (tópico, intenção)
+FEATURES_TEXTO = {
+    (topic_id, intent_id): _montar_features_texto(topic_id, intent_id)
+    for topic_id in TOPIC_IDS.values()
+    for intent_id in INTENT_IDS.values()
+}
+
+ANCORAS_LEI = ConjuntoAncoras(FEATURES_LEI)
+ANCORAS_TEXTO = {chave: ConjuntoAncoras(pares) for chave, pares in FEATURES_TEXTO.items()}
+
+RE_NUMERO_CURTO = re.compile(r'\b\d{1,2}\b')
+
+
+def extrair_features(lei: str, text: str, topic_id: int, intent_id: int) -> int:
     """
-    Calcula pontuação de releví¢ncia para um resultado
+    Converte lei/texto (já em minúsculas) no bitmask de features F_*.
+    """
+    mask = ANCORAS_LEI.mascara(lei) | ANCORAS_TEXTO[(topic_id, intent_id)].mascara(text)
+    if RE_NUMERO_CURTO.search(text):
+        mask |= F_TXT_NUMERO
+    return mask
+
+
+def score_kernel(mask: int, topic_id: int, intent_id: int, text_len: int) -> int:
+    """
+    Pontuação de relevância a partir do bitmask de features (só aritmética inteira).
     """
-    meta = resultado.get("metadata", {})
-    lei = (meta.get("lei", "") or "").lower()
-    text = (resultado.get("text", "") or "").lower()
-    
     score = 0
-    
-    # --- íncoras por tí³pico ---
-    if topic == "DISPENSA_RECOMPENSA":
-        if "dispensa recompensa" in lei:
+
+    # --- Âncoras por tópico ---
+    if topic_id == TOPIC_DISPENSA_RECOMPENSA:
+        if mask & F_LEI_DISPENSA_RECOMPENSA:
             score += 22
-        if "portaria" in lei and ("078" in lei or "78" in lei):
+        if mask & F_LEI_PORTARIA and mask & F_LEI_078:
             score += 8
-        if "dispensa" in text:
+        if mask & F_TXT_DISPENSA:
             score += 8
-        if "recompensa" in text:
+        if mask & F_TXT_RECOMPENSA:
             score += 8
-    
-    elif topic == "FERIAS":
-        if "férias" in lei or "ferias" in lei:
+
+    elif topic_id == TOPIC_FERIAS:
+        if mask & F_LEI_FERIAS:
             score += 18
-        if "férias" in text or "ferias" in text:
+        if mask & F_TXT_FERIAS:
             score += 8
-        if "gozo" in text or "período" in text or "periodo" in text:
+        if mask & F_TXT_GOZO_PERIODO:
             score += 5
-    
-    elif topic == "DISCIPLINAR":
-        if "disciplinar" in lei or "regulamento disciplinar" in lei:
+
+    elif topic_id == TOPIC_DISCIPLINAR:
+        if mask & F_LEI_DISCIPLINAR:
             score += 14
-        if "transgress" in text or "puni" in text or "penal" in text:
+        if mask & F_TXT_DISCIPLINAR:
             score += 6
-    
+
     else:
-        if "cbmac" in text:
+        if mask & F_TXT_CBMAC:
             score += 2
-    
+
     # --- Sinais gerais úteis ---
-    if "dias" in text:
+    if mask & F_TXT_DIAS:
         score += 4
-    
+
     # --- Intenção ---
-    if intent == "ANUAL":
-        if "ano" in text or "anual" in text or "por ano" in text:
+    if intent_id == INTENT_ANUAL:
+        if mask & F_TXT_ANO:
             score += 10
-        if any(x in text for x in ["limite", "máximo", "teto", "não poderá", "não exceder", "ultrapass"]):
+        if mask & F_TXT_LIMITE_ANUAL:
             score += 10
-    
-    elif intent == "ININTERRUPTO":
-        if any(x in text for x in ["ininterrupt", "consecut", "seguid", "contínuo", "continuo"]):
+
+    elif intent_id == INTENT_ININTERRUPTO:
+        if mask & F_TXT_ININTERRUPTO:
             score += 12
-    
-    elif intent == "LIMITE":
-        if any(x in text for x in ["limite", "máximo", "teto", "não exceder"]):
+
+    elif intent_id == INTENT_LIMITE:
+        if mask & F_TXT_LIMITE:
             score += 8
-    
+
     # --- Números (dias/limites) ---
-    import re
-    if re.search(r'\b\d{1,2}\b', text):
+    if mask & F_TXT_NUMERO:
         score += 3
-    
+
     # --- Penalizações ---
-    if topic != "GERAL":
+    if topic_id != TOPIC_GERAL:
         # Constituição/orçamento costuma ser ruído
-        if "constitui" in lei and "dispensa" not in text and "férias" not in text and "ferias" not in text:
+        if mask & F_LEI_CONSTITUICAO and not mask & (F_TXT_DISPENSA | F_TXT_FERIAS):
             score -= 15
-        if "orçament" in lei or "ministério público" in text:
+        if mask & (F_LEI_ORCAMENTO | F_TXT_MINISTERIO_PUBLICO):
             score -= 12
-        
+
         # Sí³ penaliza férias se não for o tí³pico
-        if topic != "FERIAS" and ("férias" in lei or "ferias" in lei) and "dispensa" not in text:
+        if topic_id != TOPIC_FERIAS and mask & F_LEI_FERIAS and not mask & F_TXT_DISPENSA:
             score -= 10
-    
+
     # Textos curtos demais
-    if len(text) < 60:
+    if text_len < 60:
         score -= 3
-    
+
     return score
 
 
-def filtrar_titulo_estrutural(meta: dict, text: str) -> bool:
+def calcular_scores_lote(leis_lc: list, textos_lc: list, topic: str, intent: str,
+                         tamanhos: list = None) -> list:
     """
-    Retorna True se for apenas um título estrutural (sem conteúdo útil)
+    Pontua um lote de resultados (lei e texto já em minúsculas): tópico e
+    intenção são resolvidos uma vez por consulta, não por resultado.
+    `tamanhos` traz o comprimento original quando os textos vêm truncados.
     """
-    artigo = (meta.get("artigo", "") or "").upper()
-    texto_upper = (text or "").upper()
-    
-    is_cap_sec_tit = any([
-        artigo.startswith("CAPíTULO"),
-        artigo.startswith("CAPITULO"),
-        artigo.startswith("SEííO"),
-        artigo.startswith("SECAO"),
-        artigo.startswith("TíTULO"),
-        artigo.startswith("TITULO")
-    ])
-    
-    return is_cap_sec_tit and len(texto_upper) < 180 and "ART." not in texto_upper
+    topic_id = TOPIC_IDS.get(topic, TOPIC_GERAL)
+    intent_id = INTENT_IDS.get(intent, INTENT_GERAL)
+
+    if tamanhos is None:
+        tamanhos = [len(t) for t in textos_lc]
 
+    return [
+        score_kernel(extrair_features(lei_lc, text_lc, topic_id, intent_id), topic_id, intent_id, tamanho)
+        for lei_lc, text_lc, tamanho in zip(leis_lc, textos_lc, tamanhos)
+    ]
 
-def processar_resultados_rag(resultados: list, topic: str, intent: str) -> list:
+
+# Só o início de cada trecho é usado na pontuação (as âncoras aparecem cedo;
+# evita copiar trechos longos inteiros no lower())
+SCORE_MAX_CHARS = 2000
+
+PREFIXOS_TITULO_ESTRUTURAL = ("CAPÍTULO", "CAPITULO", "SEÇÃO", "SECAO", "TÍTULO", "TITULO")
+
+
+# Intenções que pedem mais trechos no contexto final
+INTENTS_K_AMPLIADO = frozenset(("ANUAL", "ININTERRUPTO", "LIMITE"))
+
+
+def filtrar_titulo_estrutural(artigo: str, text_lc: str) -> bool:
     """
-    Processa resultados do RAG: pontua, filtra, deduplica e ordena
+    Retorna True se for apenas um título estrutural (sem conteúdo útil).
+    Recebe o texto já em minúsculas (o mesmo usado na pontuação).
     """
-    # 1. Normaliza e filtra
-    processados = []
+    # Textos longos nunca são títulos: evita upper/busca na maioria dos casos
+    if len(text_lc) >= 180:
+        return False
+    if not artigo or not artigo.upper().startswith(PREFIXOS_TITULO_ESTRUTURAL):
+        return False
+    return "art." not in text_lc
+
+
+RE_TOKEN = re.compile(r'\w+')
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def pontuar_bm25(pergunta_lc: str, textos_lc: list) -> list:
+    """
+    BM25 (Okapi) da pergunta contra os candidatos, com IDF calculado sobre o
+    próprio lote de candidatos.
+    """
+    termos = set(RE_TOKEN.findall(pergunta_lc))
+    docs = [Counter(RE_TOKEN.findall(t)) for t in textos_lc]
+    n = len(docs)
+    if not n or not termos:
+        return [0.0] * n
+
+    tamanhos = [sum(d.values()) for d in docs]
+    avgdl = (sum(tamanhos) / n) or 1.0
+    idf = {}
+    for termo in termos:
+        df = sum(1 for d in docs if termo in d)
+        idf[termo] = math.log((n - df + 0.5) / (df + 0.5) + 1.0)
+
+    scores = []
+    for d, dl in zip(docs, tamanhos):
+        norma = BM25_K1 * (1.0 - BM25_B + BM25_B * dl / avgdl)
+        s = 0.0
+        for termo in termos:
+            tf = d.get(termo)
+            if tf:
+                s += idf[termo] * tf * (BM25_K1 + 1.0) / (tf + norma)
+        scores.append(s)
+    return scores
+
+
+def processar_resultados_rag(resultados: list, topic: str, intent: str, pergunta: str = "") -> list:
+    """
+    Processa resultados do RAG: pontua, filtra, deduplica e ordena.
+    Com RAG_BM25_PESO > 0 e a pergunta informada, mistura o BM25 dos
+    candidatos à pontuação por âncoras.
+    """
+    # 1. Normaliza e filtra (colunas paralelas; dicts só para os selecionados)
+    ids = []
+    texts = []
+    metas = []
+    leis = []
+    artigos = []
+    leis_lc = []
+    textos_lc = []
+    tamanhos = []
     for r in resultados:
         meta = r.get("metadata", {})
         text = (r.get("text", "") or "").strip()
@@ -537,67 +1387,137 @@ def processar_resultados_rag(resultados: list, topic: str, intent: str) -> list:
         if len(text) < 40:
             continue
         
+        artigo = meta.get("artigo", "")
+        
+        # Case-fold feito uma única vez por resultado, só no trecho pontuado,
+        # e compartilhado entre o filtro de títulos e a pontuação
+        text_lc = text[:SCORE_MAX_CHARS].lower()
+        
         # Filtra títulos estruturais
-        if filtrar_titulo_estrutural(meta, text):
+        if filtrar_titulo_estrutural(artigo, text_lc):
             continue
         
-        score = calcular_score(r, topic, intent)
+        textos_lc.append(text_lc)
+        tamanhos.append(len(text))
+        leis_lc.append((meta.get("lei", "") or "").lower())
         
-        processados.append({
-            "id": r.get("id", ""),
-            "text": text,
-            "metadata": meta,
-            "lei": meta.get("lei", "Lei"),
-            "artigo": meta.get("artigo", ""),
-            "score": score
-        })
+        ids.append(r.get("id", ""))
+        texts.append(text)
+        metas.append(meta)
+        leis.append(meta.get("lei", "Lei"))
+        artigos.append(artigo)
+    
+    scores = calcular_scores_lote(leis_lc, textos_lc, topic, intent, tamanhos)
+    if RAG_BM25_PESO > 0 and pergunta:
+        bm25 = pontuar_bm25(pergunta.lower(), textos_lc)
+        scores = [
+            round(RAG_BM25_PESO * b + (1.0 - RAG_BM25_PESO) * a, 2)
+            for a, b in zip(scores, bm25)
+        ]
+    
+    final_k = 8 if intent in INTENTS_K_AMPLIADO else 6
     
-    # 2. Ordena por score
-    processados.sort(key=lambda x: x["score"], reverse=True)
+    # 2. Top-N por score com heap (N = folga para a deduplicação).
+    #    nlargest é estável, equivalente a sorted(..., reverse=True)[:N]
+    n = len(scores)
+    janela = final_k * 4
+    ordem = heapq.nlargest(janela, range(n), key=scores.__getitem__)
     
-    # 3. Deduplica por lei + artigo
+    # 3. Deduplica por lei + artigo. A ordem é decrescente, então com K
+    #    selecionados o resto (inclusive o ruído com score <= 0) não entra:
+    #    para sem montar chaves para ele.
     vistos = set()
-    deduplicados = []
-    for r in processados:
-        chave = f"{r['lei']}||{r['artigo']}"
+    selecionados = []
+    for i in ordem:
+        if len(selecionados) >= final_k:
+            break
+        chave = (leis[i], artigos[i])
         if chave not in vistos:
             vistos.add(chave)
-            deduplicados.append(r)
+            selecionados.append(i)
     
-    # 4. Seleciona top K
-    final_k = 8 if intent in ["ANUAL", "ININTERRUPTO", "LIMITE"] else 6
-    return deduplicados[:final_k]
+    # Muitas duplicatas na janela: completa com o restante ordenado
+    if len(selecionados) < final_k and janela < n:
+        for i in sorted(range(n), key=scores.__getitem__, reverse=True)[janela:]:
+            if len(selecionados) >= final_k:
+                break
+            chave = (leis[i], artigos[i])
+            if chave not in vistos:
+                vistos.add(chave)
+                selecionados.append(i)
+    
+    # 4. Materializa só os K selecionados
+    return [
+        {
+            "id": ids[i],
+            "text": texts[i],
+            "metadata": metas[i],
+            "lei": leis[i],
+            "artigo": artigos[i],
+            "score": scores[i]
+        }
+        for i in selecionados
+    ]
 
 
 async def consultar_legislacao_via_n8n(pergunta: str) -> dict:
     """
-    Consulta legislacao via webhook do n8n (processamento inteligente com RAG)
+    Consulta legislacao via webhook do n8n (processamento inteligente com RAG).
+    Respostas com sucesso ficam em cache por CACHE_N8N_TTL segundos.
+    """
+    return await cache_legislacao_n8n.obter_ou_calcular(
+        chave_cache("n8n", normalizar_consulta(pergunta)),
+        lambda: _consultar_webhook_n8n(pergunta),
+        cachear=lambda r: r.get("sucesso", False)
+    )
+
+
+async def aguardar_legislacao(leis_task: asyncio.Task, timeout: float,
+                              origem: str = "n8n", padrao=None):
+    """
+    Espera a consulta de legislação por até `timeout` segundos. Se demorar,
+    segue sem ela (retorna `padrao`, ou o erro de timeout no formato do n8n);
+    a consulta continua em segundo plano e, no n8n, preenche o cache para as
+    próximas chamadas.
     """
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "http://secretario-sei-n8n-1:5678/webhook/consultar-leis",
-                json={"pergunta": pergunta}
-            )
-            data = response.json()
-            if data.get("sucesso"):
-                return {
-                    "sucesso": True,
-                    "contexto": data.get("contexto_leis", ""),
-                    "resultados": data.get("resultados", []),
-                    "total": data.get("total", 0),
-                    "topic": data.get("topic", ""),
-                    "intent": data.get("intent", "")
-                }
-            return {"sucesso": False, "erro": "Sem resultados", "resultados": []}
+        return await asyncio.wait_for(asyncio.shield(leis_task), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning("[LEGISLACAO] %s acima de %ss, seguindo sem legislação", origem, timeout)
+        if padrao is not None:
+            return padrao
+        return {"sucesso": False, "erro": "timeout", "resultados": []}
+
+
+async def _consultar_webhook_n8n(pergunta: str) -> dict:
+    """Chamada direta ao webhook consultar-leis do n8n (sem cache)"""
+    try:
+        response = await obter_cliente_http().post(
+            "http://secretario-sei-n8n-1:5678/webhook/consultar-leis",
+            content=orjson.dumps({"pergunta": pergunta}),
+            headers=HEADERS_JSON,
+            timeout=30.0
+        )
+        data = orjson.loads(response.content)
+        if data.get("sucesso"):
+            return {
+                "sucesso": True,
+                "contexto": data.get("contexto_leis", ""),
+                "resultados": data.get("resultados", []),
+                "total": data.get("total", 0),
+                "topic": data.get("topic", ""),
+                "intent": data.get("intent", "")
+            }
+        return {"sucesso": False, "erro": "Sem resultados", "resultados": []}
     except Exception as e:
-        print(f"Erro ao consultar n8n: {e}", file=sys.stderr)
+        logger.error("Erro ao consultar n8n: %s", e)
         return {"sucesso": False, "erro": str(e), "resultados": []}
 
 
 async def consultar_legislacao_rag_inteligente(tema: str, n_results: int = 5) -> list:
     """
-    Consulta a base de legislação com Intent Detection + Query Rewrite + Scoring
+    Consulta a base de legislação com Intent Detection + Query Rewrite + Scoring.
+    Resultados não vazios ficam em cache por CACHE_RAG_TTL segundos.
     """
     try:
         # 1. Detecta intent e topic
@@ -605,47 +1525,133 @@ async def consultar_legislacao_rag_inteligente(tema: str, n_results: int = 5) ->
         topic = detection["topic"]
         intent = detection["intent"]
         
-        # 2. Reescreve a query
-        query_expandida, n_results_ajustado = reescrever_query(tema, topic, intent)
-        
-        print(f"ð Consulta legislação: topic={topic}, intent={intent}", file=sys.stderr)
-        print(f"   Query expandida: {query_expandida[:80]}...", file=sys.stderr)
-        
-        # 3. Consulta o RAG
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                "http://secretario-sei-leis-runner:8100/query",
-                json={
-                    "collection": "leis_cbmac",
-                    "query_text": query_expandida,
-                    "n_results": n_results_ajustado
-                }
-            )
-            data = response.json()
-        
-        if not data.get("ok") or not data.get("results"):
-            return []
-        
-        # 4. Processa resultados com scoring inteligente
-        resultados_processados = processar_resultados_rag(data["results"], topic, intent)
-        
-        # 5. Formata saída
-        leis = []
-        for r in resultados_processados:
-            leis.append({
-                "lei": r["lei"],
-                "artigo": r["artigo"],
-                "texto": r["text"][:500],
-                "referencia": f"{r['lei']} - {r['artigo']}" if r["artigo"] else r["lei"],
-                "score": r["score"]
-            })
-        
-        print(f"   â Encontrados: {len(leis)} resultados relevantes", file=sys.stderr)
-        return leis
+        return await cache_legislacao_rag.obter_ou_calcular(
+            chave_cache("rag", topic, intent, normalizar_consulta(tema)),
+            lambda: _consultar_rag_leis(tema, topic, intent),
+            cachear=bool
+        )
         
     except Exception as e:
-        print(f"â ï¸ Erro ao consultar legislação: {e}", file=sys.stderr)
+        logger.error("Erro ao consultar legislação: %s", e)
+        return []
+
+
+async def _consultar_rag_leis(tema: str, topic: str, intent: str) -> list:
+    """
+    Reescreve a query, consulta o RAG e formata os trechos mais relevantes.
+    """
+    # 2. Reescreve a query
+    query_expandida, n_results_ajustado = reescrever_query(tema, topic, intent)
+    if RAG_BM25_PESO > 0:
+        # Mais candidatos para o rerank local
+        n_results_ajustado = min(n_results_ajustado * 3, 50)
+    
+    logger.info("Consulta legislação: topic=%s, intent=%s", topic, intent)
+    logger.debug("   Query expandida: %s...", query_expandida[:80])
+    
+    # 3. Consulta o RAG
+    response = await obter_cliente_http().post(
+        "http://secretario-sei-leis-runner:8100/query",
+        content=orjson.dumps({
+            "collection": "leis_cbmac",
+            "query_text": query_expandida,
+            "n_results": n_results_ajustado
+        }),
+        headers=HEADERS_JSON,
+        timeout=10.0
+    )
+    data = orjson.loads(response.content)
+    
+    if not data.get("ok") or not data.get("results"):
         return []
+    
+    # 4. Processa resultados com scoring inteligente
+    resultados_processados = processar_resultados_rag(data["results"], topic, intent, tema)
+    
+    # 5. Formata saída
+    leis = []
+    for r in resultados_processados:
+        leis.append({
+            "lei": r["lei"],
+            "artigo": r["artigo"],
+            "texto": r["text"][:500],
+            "referencia": f"{r['lei']} - {r['artigo']}" if r["artigo"] else r["lei"],
+            "score": r["score"]
+        })
+    
+    logger.info("   Encontrados: %d resultados relevantes", len(leis))
+    return leis
+
+
+# Dicas de busca de legislação, em ordem de prioridade
+HINTS_DEMANDA = {
+    "ferias": "férias gozo concessão período",
+    "licenca": "licença afastamento",
+    "dispensa": "dispensa recompensa",
+    "promocao": "promoção militar",
+}
+RE_HINT_DEMANDA = re.compile(
+    r'(?P<ferias>f(?:é|e)rias)|(?P<licenca>licen(?:ç|c)a)|(?P<dispensa>dispensa)|(?P<promocao>promo(?:ção|cao))',
+    re.IGNORECASE
+)
+
+
+def detectar_hint_demanda(conteudo_processo: str) -> str:
+    """
+    Escolhe a dica de busca de legislação com uma única varredura do conteúdo.
+    Respeita a prioridade de HINTS_DEMANDA; sem palavra-chave, usa o início do texto.
+    O padrão ignora maiúsculas, então o conteúdo não é copiado com lower().
+    """
+    encontrados = set()
+    for m in RE_HINT_DEMANDA.finditer(conteudo_processo):
+        if m.lastgroup == "ferias":
+            return HINTS_DEMANDA["ferias"]
+        encontrados.add(m.lastgroup)
+
+    for chave, hint in HINTS_DEMANDA.items():
+        if chave in encontrados:
+            return hint
+
+    # Extrai palavras-chave do conteúdo
+    return conteudo_processo[:500]
+
+
+async def coletar_stream_ate_json(stream) -> str:
+    """
+    Acumula o texto de um stream do OpenAI e encerra o stream assim que o
+    primeiro objeto JSON de nível 0 é fechado (o resto seria descartado).
+    """
+    partes = []
+    profundidade = 0
+    em_string = False
+    escape = False
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            partes.append(delta)
+
+            for c in delta:
+                if em_string:
+                    if escape:
+                        escape = False
+                    elif c == "\\":
+                        escape = True
+                    elif c == '"':
+                        em_string = False
+                elif c == '"':
+                    em_string = profundidade > 0
+                elif c == "{":
+                    profundidade += 1
+                elif c == "}" and profundidade > 0:
+                    profundidade -= 1
+                    if profundidade == 0:
+                        return "".join(partes)
+    finally:
+        await stream.close()
+
+    return "".join(partes)
 
 
 async def analisar_com_ia(nup: str, conteudo_processo: str, documentos: list = None) -> Dict:
@@ -666,7 +1672,9 @@ async def analisar_com_ia(nup: str, conteudo_processo: str, documentos: list = N
         }
     
     try:
-        import openai
+        # Consulta legislação relevante no RAG em paralelo com o preparo do prompt
+        tipo_demanda_hint = detectar_hint_demanda(conteudo_processo)
+        leis_task = asyncio.create_task(consultar_legislacao_via_n8n(tipo_demanda_hint))
         
         # Carrega o prompt de análise
         prompt_template = carregar_prompt("analise_processo")
@@ -701,32 +1709,21 @@ RETORNE EXATAMENTE ESTE JSON (sem texto adicional):
   "legislacao_aplicavel": ["leis/artigos relevantes"]
 }}"""
         
-        # Monta o prompt final
-        prompt = prompt_template.replace("{nup}", nup).replace("{conteudo}", conteudo_processo[:6000])
-        # Consulta legislação relevante no RAG
-        tipo_demanda_hint = ""
-        if "férias" in conteudo_processo.lower() or "ferias" in conteudo_processo.lower():
-            tipo_demanda_hint = "férias gozo concessão período"
-        elif "licença" in conteudo_processo.lower() or "licenca" in conteudo_processo.lower():
-            tipo_demanda_hint = "licença afastamento"
-        elif "dispensa" in conteudo_processo.lower():
-            tipo_demanda_hint = "dispensa recompensa"
-        elif "promoção" in conteudo_processo.lower() or "promocao" in conteudo_processo.lower():
-            tipo_demanda_hint = "promoção militar"
-        else:
-            # Extrai palavras-chave do conteúdo
-            tipo_demanda_hint = conteudo_processo[:500]
-        
-        leis_encontradas = await consultar_legislacao_via_n8n(tipo_demanda_hint)
+        leis_encontradas = await aguardar_legislacao(leis_task, LEGISLACAO_TIMEOUT_ANALISE)
         
         legislacao_texto = ""
         if leis_encontradas.get("sucesso") and leis_encontradas.get("contexto"):
             legislacao_texto = "\n\nLEGISLAííO APLICíVEL ENCONTRADA:\n" + leis_encontradas["contexto"]
         
-        prompt = prompt.replace("{legislacao}", legislacao_texto)
+        # Monta o prompt final (uma única passada sobre o template)
+        prompt = preencher_placeholders(prompt_template, {
+            "nup": nup,
+            "conteudo": conteudo_processo[:6000],
+            "legislacao": legislacao_texto,
+        })
         
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        response = client.chat.completions.create(
+        client = obter_cliente_openai()
+        stream = await client.chat.completions.create(
             model="gpt-4.1-mini",
             messages=[
                 {
@@ -736,26 +1733,27 @@ RETORNE EXATAMENTE ESTE JSON (sem texto adicional):
                 {"role": "user", "content": prompt}
             ],
             max_tokens=2000,
-            temperature=0.3
+            temperature=0.3,
+            stream=True
         )
         
-        resposta_texto = response.choices[0].message.content.strip()
+        # Para de consumir assim que o objeto JSON raiz fecha
+        resposta_texto = (await coletar_stream_ate_json(stream)).strip()
         
         # Limpa markdown se houver
-        resposta_texto = re.sub(r'```json\s*', '', resposta_texto)
-        resposta_texto = re.sub(r'```\s*', '', resposta_texto)
+        resposta_texto = RE_FENCE.sub('', resposta_texto)
         
         # Tenta parsear JSON
         try:
-            analise = json.loads(resposta_texto)
+            analise = orjson.loads(resposta_texto)
             return analise
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             # Tenta extrair JSON do meio do texto
-            json_match = re.search(r'\{[\s\S]*\}', resposta_texto)
-            if json_match:
+            objeto = extrair_objeto_json(resposta_texto)
+            if objeto:
                 try:
-                    return json.loads(json_match.group())
-                except:
+                    return orjson.loads(objeto)
+                except orjson.JSONDecodeError:
                     pass
             
             # Se não conseguir, retorna estrutura básica com o resumo
@@ -771,7 +1769,7 @@ RETORNE EXATAMENTE ESTE JSON (sem texto adicional):
             }
             
     except Exception as e:
-        print(f"â Erro na análise IA: {e}", file=sys.stderr)
+        logger.error("Erro na análise IA: %s", e)
         return {
             "tipo_demanda": "Erro na análise",
             "resumo_executivo": f"Erro ao processar com IA: {str(e)}",
@@ -798,20 +1796,20 @@ def carregar_template(template_id: str) -> tuple:
         from modelos.templates_meta import TEMPLATES_META, MODELOS_DIR
 
         if template_id not in TEMPLATES_META:
-            print(f"[TEMPLATE] Template não encontrado: {template_id}", file=sys.stderr)
+            logger.warning("[TEMPLATE] Template não encontrado: %s", template_id)
             return None, None
 
         meta = TEMPLATES_META[template_id]
         caminho = meta.get("arquivo_path")
 
         if caminho is None or not caminho.exists():
-            print(f"[TEMPLATE] Arquivo não encontrado: {caminho}", file=sys.stderr)
+            logger.warning("[TEMPLATE] Arquivo não encontrado: %s", caminho)
             return None, None
 
         conteudo = caminho.read_text(encoding="utf-8")
         return conteudo, meta
     except Exception as e:
-        print(f"[TEMPLATE] Erro ao carregar template {template_id}: {e}", file=sys.stderr)
+        logger.error("[TEMPLATE] Erro ao carregar template %s: %s", template_id, e)
         return None, None
 
 
@@ -947,14 +1945,36 @@ def preencher_template(
         html = conteudo.format(**dados)
     except KeyError as e:
         # Se faltar algum campo, tenta substituir os que existem
-        print(f"[TEMPLATE] Campo ausente {e}, usando substituição parcial", file=sys.stderr)
-        for chave, valor in dados.items():
-            conteudo = conteudo.replace(f"{{{chave}}}", str(valor))
-        html = conteudo
+        logger.warning("[TEMPLATE] Campo ausente %s, usando substituição parcial", e)
+        html = preencher_placeholders(conteudo, dados)
 
     return html
 
 
+# ============================================================
+# HEURÍSTICA DE GÊNERO (destinatários)
+# ============================================================
+
+# Trechos de cargo explicitamente femininos (comparados em minúsculas)
+CARGOS_FEMININOS = ('diretora', 'chefa', 'assessora', 'coordenadora')
+
+# Nomes femininos comuns (lista não exaustiva)
+NOMES_FEMININOS = frozenset((
+    'MARIA', 'ANA', 'FRANCISCA', 'ANTONIA', 'ADRIANA', 'JULIANA', 'MARCIA',
+    'FERNANDA', 'PATRICIA', 'ALINE', 'SANDRA', 'CAMILA', 'AMANDA', 'BRUNA',
+    'JESSICA', 'LETICIA', 'JULIA', 'LUCIANA', 'VANESSA', 'CARLA', 'SIMONE',
+    'DANIELA', 'RENATA', 'CAROLINA', 'RAFAELA', 'CRISTIANE', 'FABIANA',
+    'CLAUDIA', 'HELENA', 'BEATRIZ', 'LARISSA', 'PRISCILA', 'TATIANA',
+    'GABRIELA', 'NATALIA', 'MONICA', 'PAULA', 'RAQUEL', 'VIVIANE', 'ELIANE',
+    'ROSANGELA', 'ROSA', 'LUCIA', 'ELIZABETH', 'TEREZA', 'EDILENE', 'EDNA',
+))
+
+# Terminam em 'A' mas não indicam nome feminino
+EXCECOES_MASCULINAS = frozenset((
+    'JOSEFA', 'COSTA', 'SOUZA', 'SILVA', 'MOURA', 'VIEIRA', 'OLIVEIRA', 'PEREIRA',
+))
+
+
 async def gerar_documento_com_ia(
     tipo: str,
     nup: str,
@@ -981,18 +2001,16 @@ async def gerar_documento_com_ia(
 
     if tem_instrucao:
         # Com instrução → vai direto para LLM interpretar contexto + instrução
-        print(f"[LLM] Instrução detectada: {instrucao_voz[:50]}...", file=sys.stderr)
+        logger.info("[LLM] Instrução detectada: %s...", instrucao_voz[:50])
     else:
         # Sem instrução → LLM usa só o contexto do processo
-        print(f"[LLM] Sem instrução - gerando baseado no contexto do processo", file=sys.stderr)
+        logger.info("[LLM] Sem instrução - gerando baseado no contexto do processo")
 
     # =========================================================
     # TENTATIVA 2: Usar LLM (OpenAI) para gerar APENAS O CORPO
     # O código monta a estrutura completa (destinatário, vocativo, fecho, assinatura)
     # =========================================================
     try:
-        import openai
-
         # Monta contexto da análise
         resumo = analise.get("resumo_executivo", "") or analise.get("resumo_processo", "") or ""
         interessado = analise.get("interessado", {})
@@ -1008,38 +2026,23 @@ async def gerar_documento_com_ia(
             Retorna 'F' para feminino, 'M' para masculino.
             """
             # 1. Verifica pelo cargo (mais confiável)
-            cargos_femininos = ['Diretora', 'Comandante Geral', 'Subcomandante', 'Chefa', 'Assessora', 'Coordenadora']
-            cargos_masculinos = ['Diretor', 'Comandante', 'Chefe', 'Assessor', 'Coordenador']
-
             cargo_lower = cargo.lower() if cargo else ''
 
             # Cargos explicitamente femininos
-            if 'diretora' in cargo_lower or 'chefa' in cargo_lower or 'assessora' in cargo_lower or 'coordenadora' in cargo_lower:
+            if any(c in cargo_lower for c in CARGOS_FEMININOS):
                 return 'F'
 
             # 2. Verifica pelo nome (heurística)
             if nome:
                 primeiro_nome = nome.split()[0].upper() if nome.split() else ''
 
-                # Nomes femininos comuns (lista não exaustiva)
-                nomes_femininos = [
-                    'MARIA', 'ANA', 'FRANCISCA', 'ANTONIA', 'ADRIANA', 'JULIANA', 'MARCIA',
-                    'FERNANDA', 'PATRICIA', 'ALINE', 'SANDRA', 'CAMILA', 'AMANDA', 'BRUNA',
-                    'JESSICA', 'LETICIA', 'JULIA', 'LUCIANA', 'VANESSA', 'CARLA', 'SIMONE',
-                    'DANIELA', 'RENATA', 'CAROLINA', 'RAFAELA', 'CRISTIANE', 'FABIANA',
-                    'CLAUDIA', 'HELENA', 'BEATRIZ', 'LARISSA', 'PRISCILA', 'TATIANA',
-                    'GABRIELA', 'NATALIA', 'MONICA', 'PAULA', 'RAQUEL', 'VIVIANE', 'ELIANE',
-                    'ROSANGELA', 'ROSA', 'LUCIA', 'ELIZABETH', 'TEREZA', 'EDILENE', 'EDNA'
-                ]
-
-                if primeiro_nome in nomes_femininos:
+                if primeiro_nome in NOMES_FEMININOS:
                     return 'F'
 
                 # Heurística: nomes terminados em 'A' geralmente são femininos
                 # (mas há exceções como ÉDEN, que não termina em A)
                 # Nomes que terminam em 'A' e não são exceções conhecidas
-                excecoes_masculinas = ['JOSEFA', 'COSTA', 'SOUZA', 'SILVA', 'MOURA', 'VIEIRA', 'OLIVEIRA', 'PEREIRA']
-                if primeiro_nome.endswith('A') and primeiro_nome not in excecoes_masculinas and len(primeiro_nome) > 2:
+                if primeiro_nome.endswith('A') and primeiro_nome not in EXCECOES_MASCULINAS and len(primeiro_nome) > 2:
                     return 'F'
 
             # Default: masculino (mais comum no CBMAC)
@@ -1220,8 +2223,7 @@ FUNDAMENTAÇÃO: {sugestao.get('fundamentacao', '-') if isinstance(sugestao, dic
             motivo = ""
             if instrucao_voz:
                 # Tenta extrair número do BG se mencionado
-                import re as re_local
-                bg_match = re_local.search(r'BG\s*n?[º°]?\s*(\d+[/-]?\d*)', instrucao_voz, re_local.IGNORECASE)
+                bg_match = RE_NUMERO_BG.search(instrucao_voz)
                 if bg_match:
                     motivo = f"a publicação no BG nº {bg_match.group(1)}"
                 elif 'deferido' in instrucao_voz.lower() or 'deferimento' in instrucao_voz.lower():
@@ -1291,10 +2293,10 @@ FORMATO HTML OBRIGATÓRIO para cada parágrafo:
 
 Gere apenas os parágrafos do corpo, nada mais."""
 
-        print(f"[LLM] Gerando corpo do documento...", file=sys.stderr)
+        logger.info("[LLM] Gerando corpo do documento...")
 
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        response = client.chat.completions.create(
+        client = obter_cliente_openai()
+        response = await client.chat.completions.create(
             model="gpt-4.1-mini",
             messages=[
                 {"role": "system", "content": "Você é um redator oficial do CBMAC. Gere apenas o corpo do documento (parágrafos), sem destinatário, vocativo, fecho ou assinatura. Use HTML com style inline."},
@@ -1307,17 +2309,15 @@ Gere apenas os parágrafos do corpo, nada mais."""
         html_corpo = response.choices[0].message.content
 
         # Limpa markdown se houver
-        html_corpo = re.sub(r'```html\s*', '', html_corpo)
-        html_corpo = re.sub(r'```\s*', '', html_corpo)
+        html_corpo = RE_FENCE.sub('', html_corpo)
         html_corpo = html_corpo.strip()
 
         # Remove qualquer NUP/Tipo que o LLM possa ter gerado
-        html_corpo = re.sub(r'<p[^>]*>\s*[•\-]?\s*NUP\s*:\s*[\d\.\-/]+.*?</p>\s*', '', html_corpo, flags=re.IGNORECASE | re.DOTALL)
-        html_corpo = re.sub(r'[•\-]?\s*NUP\s*:\s*[\d\.\-/]+\s*<br\s*/?>', '', html_corpo, flags=re.IGNORECASE)
-        html_corpo = re.sub(r'<p[^>]*>\s*</p>', '', html_corpo)  # Remove parágrafos vazios
+        html_corpo = RE_CORPO_NUP.sub('', html_corpo)
+        html_corpo = RE_P_VAZIO.sub('', html_corpo)  # Remove parágrafos vazios
         html_corpo = html_corpo.strip()
 
-        print(f"[LLM] Corpo gerado: {len(html_corpo)} chars", file=sys.stderr)
+        logger.info("[LLM] Corpo gerado: %d chars", len(html_corpo))
 
         # =========================================================
         # 7. MONTA O DOCUMENTO COMPLETO (DIFERENCIADO POR TIPO)
@@ -1394,63 +2394,102 @@ Gere apenas os parágrafos do corpo, nada mais."""
 
         html_completo = '\n'.join(partes)
 
-        print(f"[LLM] Documento completo: {len(html_completo)} chars", file=sys.stderr)
+        logger.info("[LLM] Documento completo: %d chars", len(html_completo))
 
         return {"sucesso": True, "documento": html_completo, "tipo": tipo, "nup": nup, "fonte": "llm"}
     except Exception as e:
-        print(f"[LLM] Erro: {e}", file=sys.stderr)
+        logger.error("[LLM] Erro: %s", e)
         return {"sucesso": False, "erro": str(e), "fonte": "llm"}
 
 # ============================================================
 # CLIENTE API DE EFETIVO
 # ============================================================
 
+def consulta_militar_invalida(query: str) -> bool:
+    """
+    Termos que a API de Efetivo só responderia com lista vazia: menos de 2
+    letras/dígitos, ou só dígitos com menos de 5 (pedaço curto de matrícula).
+    """
+    alnum = "".join(c for c in query if c.isalnum())
+    return len(alnum) < 2 or (alnum.isdigit() and len(alnum) < 5)
+
+
 async def buscar_militar_efetivo(query: str, limit: int = 10) -> List[Dict]:
     """
     Busca militar na API de Efetivo por nome ou matricula.
-    Retorna lista de registros encontrados.
+    Retorna lista de registros encontrados (buscas com resultado ficam em
+    cache por CACHE_MILITAR_BUSCA_TTL segundos).
     """
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            response = await client.get(
-                f"{EFETIVO_API_URL}/efetivo/search",
-                params={"q": query, "limit": limit},
-                headers={"X-API-Key": EFETIVO_API_KEY}
-            )
-            response.raise_for_status()
-            data = response.json()
-            return data.get("records", [])
-        except httpx.TimeoutException:
-            print(f"[EFETIVO] Timeout ao buscar: {query}", file=sys.stderr)
-            return []
-        except Exception as e:
-            print(f"[EFETIVO] Erro ao buscar '{query}': {e}", file=sys.stderr)
-            return []
+    return await cache_militar_busca.obter_ou_calcular(
+        chave_cache("efetivo", normalizar_consulta(query), limit),
+        lambda: _buscar_militar_efetivo(query, limit),
+        cachear=bool
+    )
+
+
+async def _buscar_militar_efetivo(query: str, limit: int) -> List[Dict]:
+    """Chamada direta ao /efetivo/search (sem cache)"""
+    try:
+        response = await obter_cliente_http().get(
+            f"{EFETIVO_API_URL}/efetivo/search",
+            params={"q": query, "limit": limit},
+            headers={"X-API-Key": EFETIVO_API_KEY},
+            timeout=10.0
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content).get("records", [])
+    except httpx.TimeoutException:
+        logger.warning("[EFETIVO] Timeout ao buscar: %s", query)
+        return []
+    except Exception as e:
+        logger.error("[EFETIVO] Erro ao buscar '%s': %s", query, e)
+        return []
 
 
 async def buscar_militar_por_matricula(matricula: str) -> Optional[Dict]:
     """
     Busca militar por matricula exata na API de Efetivo.
+    Encontrados ficam em cache por CACHE_MILITAR_TTL segundos.
     """
     # A API de Efetivo aceita matricula completa (com hifen)
     mat_busca = matricula.strip()
+    return await cache_militar.obter_ou_calcular(
+        chave_cache("efetivo", mat_busca),
+        lambda: _buscar_militar_por_matricula(mat_busca),
+        cachear=lambda r: r is not None
+    )
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            response = await client.get(
-                f"{EFETIVO_API_URL}/efetivo/{mat_busca}",
-                headers={"X-API-Key": EFETIVO_API_KEY}
-            )
-            if response.status_code == 404:
-                return None
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            print(f"[EFETIVO] Erro ao buscar matricula '{matricula}': {e}", file=sys.stderr)
+
+async def _buscar_militar_por_matricula(mat_busca: str) -> Optional[Dict]:
+    """Chamada direta ao /efetivo/{matricula} (sem cache)"""
+    try:
+        response = await obter_cliente_http().get(
+            f"{EFETIVO_API_URL}/efetivo/{mat_busca}",
+            headers={"X-API-Key": EFETIVO_API_KEY},
+            timeout=10.0
+        )
+        if response.status_code == 404:
             return None
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    except Exception as e:
+        logger.error("[EFETIVO] Erro ao buscar matricula '%s': %s", mat_busca, e)
+        return None
+
 
+@dataclass(slots=True, frozen=True)
+class MilitarRec:
+    """Militar da API de Efetivo no padrao do sistema (serializado como objeto JSON)."""
+    matricula: str
+    matricula_completa: str
+    nome: str
+    posto_grad: str
+    lotacao: str
+    cargo: str
+    formatado: str
 
-def formatar_militar(record: Dict) -> Dict:
+
+def formatar_militar(record: Dict) -> MilitarRec:
     """Formata registro da API de Efetivo no padrao do sistema."""
     matricula = record.get("matricula", "")
     nome = record.get("nome", "")
@@ -1462,29 +2501,99 @@ def formatar_militar(record: Dict) -> Dict:
     formatado = f"{posto_grad} Mat. {matricula} {nome}".strip()
     mat_base = matricula.split("-")[0] if "-" in matricula else matricula
 
-    return {
-        "matricula": mat_base,
-        "matricula_completa": matricula,
-        "nome": nome,
-        "posto_grad": posto_grad,
-        "lotacao": lotacao,
-        "cargo": cargo,
-        "formatado": formatado
-    }
+    return MilitarRec(
+        matricula=mat_base,
+        matricula_completa=matricula,
+        nome=nome,
+        posto_grad=posto_grad,
+        lotacao=lotacao,
+        cargo=cargo,
+        formatado=formatado
+    )
 
 
 # ============================================================
 # REGISTRO DOS ENDPOINTS
 # ============================================================
 
+# ============================================================
+# CREDENCIAIS SEI (POSTGRESQL DO LARAVEL)
+# ============================================================
+
+# Texto constante: o asyncpg prepara uma vez por conexão e reaproveita pelo
+# cache de statements. usuario_sei é UNIQUE, então a busca já usa o índice.
+SQL_CREDENCIAL_SEI = """
+    SELECT sei_senha_cipher, sei_senha_iv, sei_senha_tag, sei_orgao_id
+    FROM users
+    WHERE usuario_sei = $1 AND ativo = true AND sei_credencial_ativa = true
+"""
+
+
+async def _carregar_credencial_sei_db(usuario_sei: str) -> dict:
+    """
+    Busca e descriptografa a senha SEI do usuário.
+    Retorna {"credencial": CredencialSEI} ou {"erro": mensagem}.
+    """
+    if not DECRYPT_DISPONIVEL:
+        return {"erro": "Descriptografia de credenciais indisponível neste servidor"}
+
+    # Busca credenciais (conexão do pool compartilhado)
+    pool = await obter_pool_pg()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(SQL_CREDENCIAL_SEI, usuario_sei)
+
+    if not row:
+        return {"erro": f"Credenciais não encontradas para {usuario_sei}"}
+
+    cipher, iv, tag, orgao_id = row
+
+    if not cipher or not iv or not tag:
+        return {"erro": "Senha SEI não configurada. Vincule suas credenciais."}
+
+    # Descriptografa senha
+    try:
+        senha = decrypt_laravel_aes_gcm(bytes(cipher), bytes(iv), bytes(tag))
+    except Exception as e:
+        logger.error("Erro ao descriptografar: %s", e)
+        return {"erro": "Erro ao descriptografar credenciais"}
+
+    return {
+        "credencial": CredencialSEI(
+            usuario=usuario_sei,
+            senha=senha,
+            orgao_id=orgao_id or "31"
+        )
+    }
+
+
+async def obter_credencial_sei_db(usuario_sei: str) -> dict:
+    """
+    Credencial SEI do usuário com cache de CACHE_CREDENCIAL_TTL segundos
+    (só resultados válidos; buscas simultâneas do mesmo usuário esperam a primeira).
+    """
+    return await cache_credenciais_sei.obter_ou_calcular(
+        usuario_sei,
+        lambda: _carregar_credencial_sei_db(usuario_sei),
+        cachear=lambda r: "credencial" in r
+    )
+
+
 def registrar_endpoints_laravel(app):
     from fastapi import Request, Query
+    from fastapi.exceptions import RequestValidationError
+    from fastapi.exception_handlers import request_validation_exception_handler
+
+    configurar_logger()
+
+    # Fecha os pools HTTP compartilhados junto com o app
+    app.router.add_event_handler("shutdown", fechar_clientes_http)
+    app.router.add_event_handler("shutdown", parar_logger)
 
     # ==========================================================
     # ENDPOINTS DE BUSCA DE MILITAR (API EFETIVO)
     # ==========================================================
 
-    @app.get("/api/militar/buscar")
+    @app.get("/api/militar/buscar", response_class=RespostaORJSON)
     async def api_buscar_militar(
         q: str = Query(..., min_length=2, description="Termo de busca"),
         limit: int = Query(10, ge=1, le=50, description="Limite de resultados")
@@ -1498,6 +2607,17 @@ def registrar_endpoints_laravel(app):
         import time
         inicio = time.time()
 
+        # Termo sem chance de resultado: responde direto, sem chamar a API
+        if consulta_militar_invalida(q):
+            return {
+                "sucesso": True,
+                "query": q,
+                "total": 0,
+                "militares": [],
+                "tempo_ms": 0,
+                "fonte": "efetivo-api"
+            }
+
         records = await buscar_militar_efetivo(q, limit)
         militares = [formatar_militar(r) for r in records]
         tempo_ms = int((time.time() - inicio) * 1000)
@@ -1511,7 +2631,7 @@ def registrar_endpoints_laravel(app):
             "fonte": "efetivo-api"
         }
 
-    @app.get("/api/militar/{matricula}")
+    @app.get("/api/militar/{matricula}", response_class=RespostaORJSON)
     async def api_obter_militar(matricula: str):
         """
         Obtem dados completos de um militar por matricula.
@@ -1537,8 +2657,7 @@ def registrar_endpoints_laravel(app):
     # ENDPOINTS EXISTENTES
     # ==========================================================
 
-    @app.post("/api/v2/analisar-processo")
-    async def analisar_processo_v2(req: AnalisarProcessoRequest, request: Request):
+    async def _do_analisar_processo(req: AnalisarProcessoRequest) -> dict:
         """
         Endpoint principal de análise - AGORA COM IA!
         
@@ -1547,10 +2666,10 @@ def registrar_endpoints_laravel(app):
         2. Chama IA (GPT) para analisar e estruturar
         3. Retorna JSON completo para o frontend
         """
-        print(f"ð¥ /api/v2/analisar-processo - NUP: {req.nup}, Usuario: {req.credencial.usuario}", file=sys.stderr)
+        logger.info("/api/v2/analisar-processo NUP=%s usuario=%s", req.nup, req.credencial.usuario)
         
         # ETAPA 1: Extrai dados do SEI
-        print(f"   â³ Extraindo dados do SEI...", file=sys.stderr)
+        logger.info("   extraindo dados do SEI...")
         dados_sei = await chamar_sei_reader_com_credencial(req.nup, req.credencial)
         
         if not dados_sei.get("sucesso"):
@@ -1563,75 +2682,78 @@ def registrar_endpoints_laravel(app):
         # Extrai o conteúdo para análise
         conteudo_bruto = dados_sei.get("resumo_processo", "") or dados_sei.get("output_bruto", "")
         documentos = dados_sei.get("documentos", [])
+        n_docs = len(documentos)
         
-        print(f"   â SEI extraído: {len(conteudo_bruto)} chars, {len(documentos)} docs", file=sys.stderr)
+        logger.info("   SEI extraido: %d chars, %d docs", len(conteudo_bruto), n_docs)
         
         # ETAPA 2: Chama IA para analisar
-        print(f"   â³ Analisando com IA...", file=sys.stderr)
+        logger.info("   analisando com IA...")
         analise_ia = await analisar_com_ia(req.nup, conteudo_bruto, documentos)
-        print(f"   â Análise IA concluída", file=sys.stderr)
+        logger.info("   analise IA concluida")
         
         # ETAPA 3: Monta resposta completa
         # Documentos vêm com conteúdo completo quando full=True
-        documentos_completos = dados_sei.get("documentos", [])
+        conteudo_head = conteudo_bruto[:5000]
         
         return {
             "sucesso": True,
             "nup": req.nup,
             "analise": analise_ia,
-            "resumo_processo": conteudo_bruto[:3000],
-            "documentos": documentos_completos,  # Com conteúdo completo!
-            "conteudo_bruto": conteudo_bruto[:5000],
+            "resumo_processo": conteudo_head[:3000],
+            "documentos": documentos,  # Com conteúdo completo!
+            "conteudo_bruto": conteudo_head,
             # Campos extras do detalhar
             "modo": dados_sei.get("modo", ""),
             "pastas_total": dados_sei.get("pastas_total", 0),
-            "documentos_total": dados_sei.get("documentos_total", len(documentos_completos)),
-            "docs_extraidos": dados_sei.get("extraidos_ok", len(documentos_completos)),
+            "documentos_total": dados_sei.get("documentos_total", n_docs),
+            "docs_extraidos": dados_sei.get("extraidos_ok", n_docs),
             "docs_escaneados": dados_sei.get("docs_escaneados", 0),
             "ressalvas": dados_sei.get("ressalvas", []),
             "duracao_segundos": dados_sei.get("duracao_segundos", 0),
             "mensagem": dados_sei.get("mensagem", "Processo analisado com sucesso!")
         }
     
-    @app.post("/v1/gerar-documento")
-    async def gerar_documento_v1(req: GerarDocumentoRequest, request: Request):
-        """Endpoint para Laravel gerar documento com IA"""
-        print(f"ð¥ /v1/gerar-documento - NUP: {req.nup}, Tipo: {req.tipo_documento}", file=sys.stderr)
-        print(f"   ð¦ destinatarios: {req.destinatarios}", file=sys.stderr)
-        print(f"   ð¦ remetente: {req.remetente}", file=sys.stderr)
-        print(f"   🎤 instrucao_voz: {req.instrucao_voz}", file=sys.stderr)
-        
-        # Converte destinatarios de Pydantic para dict
-        destinatarios_dict = None
-        if req.destinatarios:
-            destinatarios_dict = [d.dict() for d in req.destinatarios]
+    @app.post("/api/v2/analisar-processo", response_class=RespostaORJSON)
+    async def analisar_processo_v2(req: AnalisarProcessoRequest, request: Request):
+        """Endpoint principal de análise (ver _do_analisar_processo)"""
+        return await _do_analisar_processo(req)
+    
+    async def _do_gerar_documento(req: GerarDocumentoRequest) -> dict:
+        """Gera documento com IA (compartilhado por /v1, /api/v2 e o alias do frontend)"""
+        logger.info("/v1/gerar-documento NUP=%s tipo=%s", req.nup, req.tipo_documento)
+        logger.debug("   destinatarios: %s", req.destinatarios)
+        logger.debug("   remetente: %s", req.remetente)
+        logger.debug("   instrucao_voz: %s", req.instrucao_voz)
         
-        remetente_dict = None
-        if req.remetente:
-            remetente_dict = req.remetente.dict()
+        # Converte destinatarios/remetente de Pydantic para dict (um único dump)
+        dados = req.model_dump(include={"destinatarios", "remetente"})
         
         resultado = await gerar_documento_com_ia(
             tipo=req.tipo_documento,
             nup=req.nup,
             analise=req.analise or {},
             destinatario=req.destinatario,
-            destinatarios=destinatarios_dict,
-            remetente=remetente_dict,
+            destinatarios=dados["destinatarios"] or None,
+            remetente=dados["remetente"],
             template_id=req.template_id,
             instrucao_voz=req.instrucao_voz
         )
         
         return resultado
     
-    @app.post("/api/v2/gerar-documento")
+    @app.post("/v1/gerar-documento", response_class=RespostaORJSON)
+    async def gerar_documento_v1(req: GerarDocumentoRequest, request: Request):
+        """Endpoint para Laravel gerar documento com IA"""
+        return await _do_gerar_documento(req)
+    
+    @app.post("/api/v2/gerar-documento", response_class=RespostaORJSON)
     async def gerar_documento_v2(req: GerarDocumentoRequest, request: Request):
         """Alias para /v1/gerar-documento"""
-        return await gerar_documento_v1(req, request)
+        return await _do_gerar_documento(req)
     
-    @app.post("/v1/inserir-sei")
-    async def inserir_sei_v1(req: InserirSEIRequest, request: Request):
-        """Endpoint para inserir documento no SEI"""
-        print(f"🔥 /v1/inserir-sei - NUP: {req.nup}, Tipo: {req.tipo_documento}", file=sys.stderr)
+    async def _do_inserir_sei(req: InserirSEIRequest) -> dict:
+        """Insere documento no SEI (compartilhado por /v1/inserir-sei e o alias do frontend)"""
+        logger.info("/v1/inserir-sei NUP=%s tipo=%s", req.nup, req.tipo_documento)
 
         # Extrai destinatário do HTML para preencher o iframe de Endereçamento do SEI
         # Formatos aceitos:
@@ -1653,7 +2775,7 @@ def registrar_endpoints_laravel(app):
                 nome_posto = match.group(2).strip()
                 cargo = match.group(3).strip()
                 destinatario = f"{pronome} {nome_posto}\n{cargo}"
-                print(f"   📬 destinatario extraído (formato 1): '{pronome}' '{nome_posto}' / '{cargo}'", file=sys.stderr)
+                logger.info("   destinatario extraido (formato 1): %r %r / %r", pronome, nome_posto, cargo)
 
                 # Remove o bloco de destinatário do HTML
                 html_para_sei = re.sub(
@@ -1675,7 +2797,7 @@ def registrar_endpoints_laravel(app):
                     nome = match.group(2).strip()
                     cargo = match.group(3).strip()
                     destinatario = f"{pronome} {nome}\n{cargo}"
-                    print(f"   📬 destinatario extraído (formato 2/3): '{pronome}' '{nome}' / '{cargo}'", file=sys.stderr)
+                    logger.info("   destinatario extraido (formato 2/3): %r %r / %r", pronome, nome, cargo)
 
                     html_para_sei = re.sub(
                         r'<p[^>]*>\s*(Ao\s+Sr\.|À\s+Sra\.|Ao\(À\)\s*Sr\(a\)\.)\s*<b>[^<]+</b><br>[^<]+</p>\s*',
@@ -1684,49 +2806,42 @@ def registrar_endpoints_laravel(app):
                         flags=re.IGNORECASE
                     )
                 else:
-                    print(f"   📬 destinatario: não encontrado no HTML", file=sys.stderr)
+                    logger.info("   destinatario: nao encontrado no HTML")
         else:
-            print(f"   📬 destinatario: '{destinatario[:50] if destinatario else 'vazio'}'", file=sys.stderr)
+            logger.info("   destinatario: %r", destinatario[:50] if destinatario else "vazio")
 
-        print(f"   📄 html length: {len(html_para_sei)} chars", file=sys.stderr)
+        logger.info("   html length: %d chars", len(html_para_sei))
 
         try:
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(
-                    f"{SEI_RUNNER_URL}/run",
-                    json={
-                        "mode": "atuar",
-                        "nup": req.nup,
-                        "tipo_documento": req.tipo_documento,
-                        "destinatario": destinatario,
-                        "texto_despacho": limpar_html_para_sei(html_para_sei) if html_para_sei else "",
-                        "credentials": {
-                            "usuario": req.credencial.usuario,
-                            "senha": req.credencial.senha,
-                            "orgao_id": req.credencial.orgao_id
-                        }
+            response = await post_sei_runner(
+                "/run",
+                {
+                    "mode": "atuar",
+                    "nup": req.nup,
+                    "tipo_documento": req.tipo_documento,
+                    "destinatario": destinatario,
+                    "texto_despacho": limpar_html_para_sei(html_para_sei) if html_para_sei else "",
+                    "credentials": {
+                        "usuario": req.credencial.usuario,
+                        "senha": req.credencial.senha,
+                        "orgao_id": req.credencial.orgao_id
                     }
-                )
-                data = response.json()
-            
-            if not data.get("ok"):
-                return {"sucesso": False, "erro": data.get("error", "Erro ao inserir")}
-
-            # Usa json_data parseado pelo Runner (stdout do script)
-            json_data = data.get("json_data")
-            if json_data and isinstance(json_data, dict):
-                return json_data
-
-            # Fallback: retorna erro com output para diagnóstico
-            output = data.get("output", "")
-            return {"sucesso": False, "erro": "Não foi possível extrair resultado do script", "output": output[:1000]}
+                },
+                timeout=180.0
+            )
+            return resultado_run_sei(response, "Erro ao inserir")
         except Exception as e:
             return {"sucesso": False, "erro": str(e)}
 
-    @app.post("/v1/assinar")
+    @app.post("/v1/inserir-sei", response_class=RespostaORJSON)
+    async def inserir_sei_v1(req: InserirSEIRequest, request: Request):
+        """Endpoint para inserir documento no SEI"""
+        return await _do_inserir_sei(req)
+
+    @app.post("/v1/assinar", response_class=RespostaORJSON)
     async def assinar_sei_v1(req: AssinarSEIRequest, request: Request):
         """Endpoint para assinar documento no SEI (step-up flow)"""
-        print(f"\U0001f525 /v1/assinar - SEI: {req.sei_numero}", file=sys.stderr)
+        logger.info("/v1/assinar SEI=%s", req.sei_numero)
 
         try:
             creds = {
@@ -1739,42 +2854,32 @@ def registrar_endpoints_laravel(app):
             if req.credencial.cargo:
                 creds["cargo"] = req.credencial.cargo
 
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(
-                    f"{SEI_RUNNER_URL}/run",
-                    json={
-                        "mode": "assinar",
-                        "sei_numero": req.sei_numero,
-                        "credentials": creds,
-                    }
-                )
-                data = response.json()
-
-            if not data.get("ok"):
-                return {"sucesso": False, "erro": data.get("error", "Erro ao assinar")}
-
-            json_data = data.get("json_data")
-            if json_data and isinstance(json_data, dict):
-                return json_data
-
-            output = data.get("output", "")
-            return {"sucesso": False, "erro": "Não foi possível extrair resultado do script", "output": output[:1000]}
+            response = await post_sei_runner(
+                "/run",
+                {
+                    "mode": "assinar",
+                    "sei_numero": req.sei_numero,
+                    "credentials": creds,
+                },
+                timeout=180.0
+            )
+            return resultado_run_sei(response, "Erro ao assinar")
         except Exception as e:
             return {"sucesso": False, "erro": str(e)}
 
-    @app.post("/api/v2/testar-credencial")
+    @app.post("/api/v2/testar-credencial", response_class=RespostaORJSON)
     async def testar_credencial_v2(credencial: CredencialSEI):
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{SEI_RUNNER_URL}/testar-login", 
-                    json={
-                        "usuario": credencial.usuario, 
-                        "senha": credencial.senha, 
-                        "orgao_id": credencial.orgao_id
-                    }
-                )
-                data = response.json()
+            response = await post_sei_runner(
+                "/testar-login",
+                {
+                    "usuario": credencial.usuario, 
+                    "senha": credencial.senha, 
+                    "orgao_id": credencial.orgao_id
+                },
+                timeout=60.0
+            )
+            data = orjson.loads(response.content)
             return {
                 "sucesso": data.get("ok", False), 
                 "mensagem": data.get("message", ""), 
@@ -1783,7 +2888,7 @@ def registrar_endpoints_laravel(app):
         except Exception as e:
             return {"sucesso": False, "erro": str(e)}
     
-    @app.get("/api/v2/health")
+    @app.get("/api/v2/health", response_class=RespostaORJSON)
     async def health_v2():
         return {
             "status": "ok",
@@ -1793,14 +2898,21 @@ def registrar_endpoints_laravel(app):
             "version": "3.0"
         }
 
-    @app.post("/api/debug/capturar-editor-sei")
+    @app.post("/api/debug/recarregar-prompts", response_class=RespostaORJSON)
+    async def recarregar_prompts():
+        """DEBUG: Descarta os prompts em cache para reler os arquivos de /app/prompts."""
+        info = carregar_prompt.cache_info()
+        carregar_prompt.cache_clear()
+        return {"sucesso": True, "prompts_descartados": info.currsize}
+
+    @app.post("/api/debug/capturar-editor-sei", response_class=RespostaORJSON)
     async def capturar_editor_sei(request: Request):
         """
         DEBUG: Captura a estrutura HTML do editor de documentos do SEI.
         Usado para analisar como o SEI monta os campos (destinatário, corpo, etc).
         """
         try:
-            data = await request.json()
+            data = orjson.loads(await request.body())
             nup = data.get("nup")
             tipo_documento = data.get("tipo_documento", "Memorando")
             credencial = data.get("credencial", {})
@@ -1810,23 +2922,23 @@ def registrar_endpoints_laravel(app):
             if not credencial.get("usuario") or not credencial.get("senha"):
                 return {"sucesso": False, "erro": "Credenciais (usuario/senha) são obrigatórias"}
 
-            print(f"🔍 DEBUG: Capturando estrutura editor SEI - NUP: {nup}, Tipo: {tipo_documento}", file=sys.stderr)
-
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    f"{SEI_RUNNER_URL}/run",
-                    json={
-                        "mode": "capturar_editor",
-                        "nup": nup,
-                        "tipo_documento": tipo_documento,
-                        "credentials": {
-                            "usuario": credencial.get("usuario"),
-                            "senha": credencial.get("senha"),
-                            "orgao_id": credencial.get("orgao_id", "31")
-                        }
+            logger.info("DEBUG: capturando estrutura editor SEI NUP=%s tipo=%s", nup, tipo_documento)
+
+            response = await post_sei_runner(
+                "/run",
+                {
+                    "mode": "capturar_editor",
+                    "nup": nup,
+                    "tipo_documento": tipo_documento,
+                    "credentials": {
+                        "usuario": credencial.get("usuario"),
+                        "senha": credencial.get("senha"),
+                        "orgao_id": credencial.get("orgao_id", "31")
                     }
-                )
-                data = response.json()
+                },
+                timeout=120.0
+            )
+            data = orjson.loads(response.content)
 
             if not data.get("ok"):
                 return {"sucesso": False, "erro": data.get("error", "Erro ao capturar"), "output": data.get("output", "")[:2000]}
@@ -1841,142 +2953,70 @@ def registrar_endpoints_laravel(app):
             import traceback
             return {"sucesso": False, "erro": str(e), "traceback": traceback.format_exc()}
 
-    @app.post("/api/melhorar-texto")
-    async def melhorar_texto_endpoint(request: Request):
-        """Melhora texto usando OpenAI"""
-        try:
-            data = await request.json()
-            texto = data.get("texto", "")
-            
-            if not texto:
-                return {"sucesso": False, "erro": "Texto não fornecido"}
-            
-            import openai
-            
-            prompt = f"""Você é um revisor de documentos oficiais do CBMAC.
-
-Melhore o texto abaixo, corrigindo:
-- Erros gramaticais e ortográficos
-- Concordí¢ncia verbal e nominal
-- Clareza e objetividade
-- Formalidade adequada
-
-Texto original:
-{texto}
-
-Retorne APENAS o texto melhorado em HTML (use <p>, <br>, <strong>), sem explicações."""
-
-            client = openai.OpenAI(api_key=OPENAI_API_KEY)
-            response = client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {"role": "system", "content": "Você melhora textos oficiais mantendo formalidade."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=2000,
-                temperature=0.3
-            )
-            
-            texto_melhorado = response.choices[0].message.content
-            texto_melhorado = re.sub(r'```html\s*', '', texto_melhorado)
-            texto_melhorado = re.sub(r'```\s*', '', texto_melhorado)
-            
-            return {
-                "sucesso": True,
-                "texto_melhorado": texto_melhorado,
-                "modelo_usado": "gpt-4.1-mini"
-            }
-        except Exception as e:
-            return {"sucesso": False, "erro": str(e)}
-    
-
-    @app.post("/api/consultar-lei")
-    async def consultar_lei_endpoint(request: Request):
-        """Endpoint para consultar legislação via RAG"""
+    async def _do_chat(req: ChatRequest, stream: bool = False):
+        """Chat analítico com contexto do processo ("stream": true ou ?stream=1 responde via SSE)"""
         try:
-            data = await request.json()
-            consulta = data.get("consulta", "")
-            n_results = data.get("n_results", 5)
-            
-            if not consulta:
-                return {"sucesso": False, "erro": "Consulta não informada", "resultados": []}
-            
-            # Consulta o RAG via webhook n8n
-            resultado_n8n = await consultar_legislacao_via_n8n(consulta)
-            
-            # Usa resultados do n8n
-            if resultado_n8n.get("sucesso"):
-                return {
-                    "sucesso": True,
-                    "resultados": resultado_n8n.get("resultados", []),
-                    "total": resultado_n8n.get("total", 0),
-                    "contexto": resultado_n8n.get("contexto", "")
-                }
-            
-            return {
-                "sucesso": True,
-                "resultados": [],
-                "total": 0
-            }
-        except Exception as e:
-            print(f"â Erro ao consultar legislação: {e}", file=sys.stderr)
-            return {"sucesso": False, "erro": str(e), "resultados": []}
-
-
-    @app.post("/api/chat")
-    async def chat_analitico_endpoint(request: Request):
-        """Endpoint para chat analítico com contexto do processo"""
-        try:
-            data = await request.json()
-            mensagem = data.get("mensagem", "")
-            texto_processo = data.get("texto_canonico", "")
-            modelo = data.get("modelo_forcado", "gpt-4.1-mini")
-            user_id = data.get("user_id", "")
+            mensagem = req.mensagem
+            streaming = req.stream or stream
+            texto_processo = req.texto_canonico
+            modelo = req.modelo_forcado or "gpt-4.1-mini"
             
             if not mensagem:
                 return {"sucesso": False, "erro": "Mensagem não informada"}
             
-            import openai
+            # Consulta legislação relevante em paralelo com a montagem do contexto
+            leis_task = asyncio.create_task(consultar_legislacao_via_n8n(mensagem))
+            
+            # Monta o contexto
+            contexto = ""
+            if texto_processo:
+                contexto = f"\n\nCONTEXTO DO PROCESSO:\n{texto_processo[:4000]}"
             
-            # Consulta legislação relevante baseada na mensagem
             leis_context = ""
             try:
-                resultado_leis = await consultar_legislacao_via_n8n(mensagem)
+                resultado_leis = await aguardar_legislacao(leis_task, LEGISLACAO_TIMEOUT_CHAT)
                 if resultado_leis.get("sucesso") and resultado_leis.get("contexto"):
                     leis_context = "\n\nLEGISLAííO RELEVANTE ENCONTRADA:\n" + resultado_leis["contexto"]
             except:
                 pass
             
-            # Monta o contexto
-            contexto = ""
-            if texto_processo:
-                contexto = f"\n\nCONTEXTO DO PROCESSO:\n{texto_processo[:4000]}"
+            # Só a parte variável é montada por chamada
+            contexto_dinamico = (leis_context + contexto).strip()
+            messages = [{"role": "system", "content": ARGUS_SYSTEM_PROMPT}]
+            if contexto_dinamico:
+                messages.append({"role": "system", "content": contexto_dinamico})
+            messages.append({"role": "user", "content": mensagem})
+
+            chave = chave_cache("chat", modelo, contexto_dinamico, mensagem)
+            resposta = cache_respostas_llm.get(chave)
+            if resposta is not None:
+                if streaming:
+                    return resposta_sse(eventos_sse_texto(resposta))
+                return {
+                    "sucesso": True,
+                    "resposta": resposta,
+                    "modelo": modelo,
+                    "cache": True
+                }
             
-            system_prompt = f"""Você é o ARGUS, assistente inteligente do CBMAC (Corpo de Bombeiros Militar do Acre).
-
-Sua função é auxiliar na análise de processos administrativos, responder dúvidas sobre legislação e ajudar na redação de documentos.
-
-REGRAS:
-- Use linguagem formal administrativa
-- Cite a legislação quando relevante
-- Seja objetivo e claro
-- Se não souber, diga que não sabe
-- Use HTML para formatação: <b>, <i>, <p>, <br>, <ul>, <li>
-{leis_context}
-{contexto}"""
-
-            client = openai.OpenAI(api_key=OPENAI_API_KEY)
-            response = client.chat.completions.create(
+            client = obter_cliente_openai()
+            response = await client.chat.completions.create(
                 model=modelo,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": mensagem}
-                ],
+                messages=messages,
                 max_tokens=2000,
-                temperature=0.7
+                temperature=0.7,
+                stream=streaming
             )
             
+            if streaming:
+                def _guardar(resposta_completa: str):
+                    if resposta_completa:
+                        cache_respostas_llm.set(chave, resposta_completa)
+                return resposta_sse(eventos_sse_openai(response, ao_concluir=_guardar))
+            
             resposta = response.choices[0].message.content
+            if resposta:
+                cache_respostas_llm.set(chave, resposta)
             
             return {
                 "sucesso": True,
@@ -1985,10 +3025,10 @@ REGRAS:
             }
             
         except Exception as e:
-            print(f"â Erro no chat: {e}", file=sys.stderr)
+            logger.error("Erro no chat: %s", e)
             return {"sucesso": False, "erro": str(e)}
 
-    print("â Endpoints Laravel v3.1 registrados (ANíLISE IA + JSON COMPLETO!)")
+    logger.info("Endpoints Laravel v3.1 registrados (analise IA + JSON completo)")
 
     
     # ============================================================
@@ -1996,92 +3036,79 @@ REGRAS:
     # ============================================================
     
     
-    @app.post("/api/processos/gerar-documento")
+    @app.post("/api/processos/gerar-documento", response_class=RespostaORJSON)
     async def gerar_documento_alias(req: GerarDocumentoRequest):
         """Alias para /api/v2/gerar-documento"""
-        return await gerar_documento_v2(req)
+        return await _do_gerar_documento(req)
     
-    @app.post("/api/processos/inserir-sei")
+    @app.post("/api/processos/inserir-sei", response_class=RespostaORJSON)
     async def inserir_sei_alias(req: InserirSEIRequest):
         """Alias para v1/inserir-sei"""
-        return await inserir_documento_sei(req)
+        return await _do_inserir_sei(req)
     
-    @app.post("/api/processos/chat")
-    async def chat_alias(request: Request):
-        """Alias para /api/chat"""
-        return await chat_analitico_endpoint(request)
+    @app.post("/api/processos/chat", response_class=RespostaORJSON)
+    async def chat_alias(req: ChatRequest, stream: bool = Query(False)):
+        """
+        Chat com contexto do processo e legislação do n8n ("stream": true ou
+        ?stream=1 responde via SSE). O /api/chat do frontend é o do api.py.
+        """
+        return await _do_chat(req, stream)
     
-    print("â Aliases de compatibilidade registrados")
+    logger.info("Aliases de compatibilidade registrados")
 
 
     # ============================================================
     # BUSCA CREDENCIAIS DO POSTGRESQL
     # ============================================================
     
-    @app.post("/api/processos/analisar")
-    async def analisar_com_credenciais_db(request: Request):
+    @app.post("/api/processos/analisar", response_class=RespostaORJSON)
+    async def analisar_com_credenciais_db(req_db: AnalisarComCredenciaisDBRequest):
         """
         Analisa processo buscando credenciais do PostgreSQL.
         Frontend envia: { nup, usuario_sei }
         """
-        import psycopg2
-        from decrypt_laravel import decrypt_laravel_aes_gcm
-        
         try:
-            data = await request.json()
-            nup = data.get("nup")
-            usuario_sei = data.get("usuario_sei")
+            nup = req_db.nup
+            usuario_sei = req_db.usuario_sei
             
             if not nup or not usuario_sei:
                 return {"sucesso": False, "erro": "NUP e usuario_sei são obrigatí³rios"}
             
-            # Conecta no PostgreSQL
-            conn = psycopg2.connect(
-                host=os.getenv("DB_HOST", "plattargus-db"),
-                port=os.getenv("DB_PORT", "5432"),
-                database=os.getenv("DB_DATABASE", "plattargus_web"),
-                user=os.getenv("DB_USERNAME", "plattargus_web"),
-                password=os.getenv("DB_PASSWORD", "")
-            )
-            cursor = conn.cursor()
-            
-            # Busca credenciais
-            cursor.execute("""
-                SELECT sei_senha_cipher, sei_senha_iv, sei_senha_tag, sei_orgao_id, sei_cargo
-                FROM users 
-                WHERE usuario_sei = %s AND ativo = true AND sei_credencial_ativa = true
-            """, (usuario_sei,))
-            
-            row = cursor.fetchone()
-            conn.close()
-            
-            if not row:
-                return {"sucesso": False, "erro": f"Credenciais não encontradas para {usuario_sei}"}
-            
-            cipher, iv, tag, orgao_id, cargo = row
-            
-            if not cipher or not iv or not tag:
-                return {"sucesso": False, "erro": "Senha SEI não configurada. Vincule suas credenciais."}
-            
-            # Descriptografa senha
-            try:
-                senha = decrypt_laravel_aes_gcm(bytes(cipher), bytes(iv), bytes(tag))
-            except Exception as e:
-                print(f"â Erro ao descriptografar: {e}", file=sys.stderr)
-                return {"sucesso": False, "erro": "Erro ao descriptografar credenciais"}
+            cred = await obter_credencial_sei_db(usuario_sei)
+            if "erro" in cred:
+                return {"sucesso": False, "erro": cred["erro"]}
             
             # Chama a análise com credenciais
-            credencial = CredencialSEI(
-                usuario=usuario_sei,
-                senha=senha,
-                orgao_id=orgao_id or "31"
-            )
+            req = AnalisarProcessoRequest(nup=nup, credencial=cred["credencial"])
+            resultado = await _do_analisar_processo(req)
+            
+            # Falha no SEI (ex.: senha trocada): relê do banco na próxima vez
+            if not resultado.get("sucesso"):
+                cache_credenciais_sei.descartar(usuario_sei)
             
-            req = AnalisarProcessoRequest(nup=nup, credencial=credencial)
-            return await analisar_processo_v2(req)
+            return resultado
             
         except Exception as e:
-            print(f"â Erro em analisar_com_credenciais_db: {e}", file=sys.stderr)
+            logger.error("Erro em analisar_com_credenciais_db: %s", e)
             return {"sucesso": False, "erro": str(e)}
 
-    print("â Endpoint /api/processos/analisar (PostgreSQL) registrado")
+    logger.info("Endpoint /api/processos/analisar (PostgreSQL) registrado")
+
+    # ============================================================
+    # CORPO INVÁLIDO NAS ROTAS QUE LIAM request.json()
+    # ============================================================
+    # Essas rotas respondiam {"sucesso": False, "erro": ...} (HTTP 200) a um
+    # corpo malformado; mantém esse formato em vez do 422 do FastAPI.
+    # As demais rotas do app seguem com o tratamento padrão.
+    rotas_corpo_invalido = {chat_alias, analisar_com_credenciais_db}
+
+    async def tratar_corpo_invalido(request: Request, exc: RequestValidationError):
+        if request.scope.get("endpoint") not in rotas_corpo_invalido:
+            return await request_validation_exception_handler(request, exc)
+        erro = "; ".join(
+            f"{'.'.join(str(p) for p in e['loc'][1:]) or 'corpo'}: {e['msg']}"
+            for e in exc.errors()
+        )
+        return RespostaORJSON({"sucesso": False, "erro": f"Corpo inválido ({erro})"})
+
+    app.add_exception_handler(RequestValidationError, tratar_corpo_invalido)